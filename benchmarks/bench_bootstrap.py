@@ -0,0 +1,107 @@
+#!/usr/bin/env python3
+"""
+Measures bootstrap server registrations per second on loopback.
+
+Starts bootstrap_server.py in a subprocess and registers distinct peers over
+several persistent connections, pipelining BATCH requests at a time. Then
+compares peer list lookups: full get_peers replies against the get_peers_since
+deltas a client with a cached list sends.
+
+Usage: python3 benchmarks/bench_bootstrap.py [num_peers] [connections] [port] [lookups]
+"""
+import json
+import os
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from utils import MessageReader
+
+BATCH = 100
+
+def register_many(port, first_port, count):
+    """
+    Registers count peers over one connection and waits for every acknowledgement.
+    """
+    s = socket.create_connection(("127.0.0.1", port))
+    reader = MessageReader(s)
+    try:
+        for start in range(0, count, BATCH):
+            batch = range(first_port + start, first_port + min(start + BATCH, count))
+            s.sendall(b"".join(json.dumps({"action": "register", "address": "10.0.0.1", "port": p}).encode() + b"\n"
+                               for p in batch))
+            for _ in batch:
+                if reader.read_message().get("status") != "registered":
+                    raise RuntimeError("Registration failed")
+    finally:
+        s.close()
+
+def lookup_many(port, count, incremental):
+    """
+    Sends count peer list lookups over one connection, one at a time as clients do.
+    Incremental lookups ask for the changes since the version of the first reply.
+    """
+    s = socket.create_connection(("127.0.0.1", port))
+    reader = MessageReader(s)
+    try:
+        request = {"action": "get_peers_since"} if incremental else {"action": "get_peers"}
+        for _ in range(count):
+            s.sendall(json.dumps(request).encode() + b"\n")
+            response = reader.read_message()
+            if incremental:
+                request = {"action": "get_peers_since", "since": response["version"], "epoch": response["epoch"]}
+    finally:
+        s.close()
+
+def run_threads(target, connections, args):
+    """
+    Runs target on connections threads at once, with args(i) as the arguments of
+    thread i, and returns the seconds until all of them finished.
+    """
+    threads = [threading.Thread(target=target, args=args(i)) for i in range(connections)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start
+
+def wait_for_port(port, timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port)).close()
+            return
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError(f"Bootstrap server did not start on port {port}")
+
+def main():
+    num_peers = int(sys.argv[1]) if len(sys.argv) > 1 else 50000
+    connections = int(sys.argv[2]) if len(sys.argv) > 2 else 8
+    port = int(sys.argv[3]) if len(sys.argv) > 3 else 8900
+    lookups = int(sys.argv[4]) if len(sys.argv) > 4 else 2000
+    server = subprocess.Popen([sys.executable, os.path.join(ROOT, "bootstrap_server.py"), "--port", str(port)],
+                              stdout=subprocess.DEVNULL)
+    try:
+        wait_for_port(port)
+        per_connection = num_peers // connections
+        elapsed = run_threads(register_many, connections, lambda i: (port, i * per_connection, per_connection))
+        total = per_connection * connections
+        print(f"{total} registrations in {elapsed:.2f}s ({total / elapsed:.0f}/s over {connections} connections)")
+        total = lookups * connections
+        for label, incremental in (("get_peers", False), ("get_peers_since", True)):
+            elapsed = run_threads(lookup_many, connections, lambda i: (port, lookups, incremental))
+            print(f"{total} {label} lookups in {elapsed:.2f}s ({total / elapsed:.0f}/s, "
+                  f"{elapsed / lookups * 1000:.2f} ms each)")
+    finally:
+        server.terminate()
+        server.wait()
+
+if __name__ == '__main__':
+    main()
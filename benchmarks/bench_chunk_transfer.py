@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+"""
+Loopback benchmark comparing JSON/Base64 chunk transfer, binary frames and
+binary frames pipelined over one persistent connection.
+
+Usage: python3 benchmarks/bench_chunk_transfer.py [size_mb] [port]
+"""
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import peer
+
+def run_transfer(port, filename, num_chunks, binary):
+    """
+    Fetches every chunk of filename from the local peer and returns elapsed seconds.
+    """
+    start = time.perf_counter()
+    for i in range(num_chunks):
+        data = peer.fetch_chunk("127.0.0.1", port, filename, i, binary)
+        if data is None:
+            raise RuntimeError(f"Chunk {i} could not be fetched")
+    return time.perf_counter() - start
+
+def run_pipelined(port, filename, num_chunks):
+    """
+    Fetches every chunk over one persistent connection and returns elapsed seconds.
+    """
+    start = time.perf_counter()
+    conn = peer.PeerConnection("127.0.0.1", port)
+    try:
+        for i, data in conn.fetch_chunks(filename, range(num_chunks)):
+            if data is None:
+                raise RuntimeError(f"Chunk {i} could not be fetched")
+    finally:
+        conn.close()
+    return time.perf_counter() - start
+
+def main():
+    size_mb = int(sys.argv[1]) if len(sys.argv) > 1 else 64
+    port = int(sys.argv[2]) if len(sys.argv) > 2 else 10900
+    workdir = tempfile.mkdtemp(prefix="p2p-bench-")
+    os.chdir(workdir)
+    os.makedirs("files")
+    filename = "bench.bin"
+    with open(os.path.join("files", filename), "wb") as f:
+        f.write(os.urandom(size_mb * 1024 * 1024))
+    peer.share_file(filename)
+    threading.Thread(target=peer.server_listener, args=(port,), daemon=True).start()
+    time.sleep(0.2)
+
+    num_chunks = peer.shared_files[filename]["num_chunks"]
+    chunk_size = peer.shared_files[filename]["chunk_size"]
+    runs = (
+        ("json+base64", lambda: run_transfer(port, filename, num_chunks, False)),
+        ("binary frames", lambda: run_transfer(port, filename, num_chunks, True)),
+        ("pipelined", lambda: run_pipelined(port, filename, num_chunks)),
+    )
+    for label, run in runs:
+        elapsed = run()
+        mb_per_s = size_mb / elapsed
+        print(f"{label:>14}: {size_mb} MB in {elapsed:.2f}s ({mb_per_s:.1f} MB/s, {chunk_size // 1024}KB chunks)")
+
+if __name__ == '__main__':
+    main()
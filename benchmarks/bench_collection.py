@@ -0,0 +1,109 @@
+#!/usr/bin/env python3
+"""
+Many-small-files benchmark on loopback. Starts a bootstrap server, one seed and
+one leecher (see bench_swarm.py) and moves the same set of small files twice:
+once shared and fetched file by file with `get <filename>`, and once as a single
+collection with `get <directory>`. Prints files per second and MB/s for both.
+
+Usage: python3 benchmarks/bench_collection.py [num_files] [file_kb] [--peer-args "--server async"]
+"""
+import argparse
+import filecmp
+import os
+import shlex
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_swarm import Node, free_port
+
+COLLECTION = "small"
+
+def make_files(directory, num_files, file_size):
+    os.makedirs(directory)
+    names = [f"file{i:05d}.bin" for i in range(num_files)]
+    for name in names:
+        with open(os.path.join(directory, name), "wb") as f:
+            f.write(os.urandom(file_size))
+    return names
+
+def run(workdir, source, names, collection, peer_args):
+    """
+    Returns the seconds the leecher took to download every file, either one
+    `get` per file or one `get` of the whole collection.
+    """
+    bootstrap_port = free_port()
+    nodes = []
+    try:
+        bootstrap = Node("bootstrap_server.py", ["--port", bootstrap_port], workdir)
+        nodes.append(bootstrap)
+        bootstrap.wait_for("listening")
+        peers = []
+        for role in ("seed", "leecher"):
+            os.makedirs(os.path.join(workdir, role, "files"))
+            node = Node("peer.py", [free_port(), "--bootstrap", f"127.0.0.1:{bootstrap_port}"] + peer_args,
+                        os.path.join(workdir, role))
+            nodes.append(node)
+            node.wait_for("Peer listening")
+            peers.append(node)
+        seed, leecher = peers
+        seed_files = os.path.join(workdir, "seed", "files")
+        if collection:
+            os.mkdir(os.path.join(seed_files, COLLECTION))
+            for name in names:
+                os.link(os.path.join(source, name), os.path.join(seed_files, COLLECTION, name))
+            seed.send(f"share {COLLECTION}")
+            seed.wait_for("is now shared")
+        else:
+            for name in names:
+                os.link(os.path.join(source, name), os.path.join(seed_files, name))
+                seed.send(f"share {name}")
+            for _ in names:
+                seed.wait_for("is now shared")
+
+        started = time.perf_counter()
+        if collection:
+            leecher.send(f"get {COLLECTION}")
+            _, match = leecher.wait_for(r"downloaded successfully|again to resume|not found on any peers")
+            if "successfully" not in match.group(0):
+                raise RuntimeError("Collection download failed")
+        else:
+            for name in names:
+                leecher.send(f"get {name}")
+            for _ in names:
+                _, match = leecher.wait_for(r"downloaded successfully|again to resume|not found on any peers")
+                if "successfully" not in match.group(0):
+                    raise RuntimeError("File download failed")
+        elapsed = time.perf_counter() - started
+
+        target = os.path.join(workdir, "leecher", "files", COLLECTION if collection else "")
+        for name in names:
+            if not filecmp.cmp(os.path.join(source, name), os.path.join(target, name), shallow=False):
+                raise RuntimeError(f"{name} differs after download")
+        return elapsed
+    finally:
+        for node in reversed(nodes):
+            node.stop()
+
+def main():
+    parser = argparse.ArgumentParser(description="Per-file versus collection downloads of many small files")
+    parser.add_argument("num_files", nargs="?", type=int, default=1000, help="Files to move (default: 1000)")
+    parser.add_argument("file_kb", nargs="?", type=float, default=4, help="Size of each file in KB (default: 4)")
+    parser.add_argument("--peer-args", default="", help="Extra arguments passed to both peer.py nodes")
+    args = parser.parse_args()
+    peer_args = shlex.split(args.peer_args)
+    file_size = int(args.file_kb * 1024)
+    total_mb = args.num_files * file_size / (1024 * 1024)
+
+    with tempfile.TemporaryDirectory() as workdir:
+        source = os.path.join(workdir, "source")
+        names = make_files(source, args.num_files, file_size)
+        for label, collection in (("Per-file get", False), ("Collection get", True)):
+            elapsed = run(tempfile.mkdtemp(dir=workdir), source, names, collection, peer_args)
+            print(f"{label}: {args.num_files} files of {args.file_kb:g} KB in {elapsed:.2f}s, "
+                  f"{args.num_files / elapsed:.0f} files/s, {total_mb / elapsed:.1f} MB/s")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,277 @@
+#!/usr/bin/env python3
+"""
+End-to-end loopback benchmark. Starts bootstrap_server.py and peer.py nodes as
+subprocesses, each in its own working directory with a synthetic file, drives
+them through their CLI and writes the results as JSON.
+
+For every combination of file size, chunk size, seed count and leecher count it measures:
+- share_file hashing rate on the seeds
+- time from `get` to the first verified chunk
+- end-to-end download throughput, per leecher and in aggregate
+- seed CPU seconds per GB delivered (Linux only, read from /proc)
+Bootstrap registrations per second are measured once per invocation.
+
+Usage: python3 benchmarks/bench_swarm.py [--sizes 16,64] [--chunk-sizes auto,64,1024] [--seeds 1,2] [--leechers 1,2]
+                                         [--peer-args "--server async"] [--output results.json]
+                                         [--compare baseline.json]
+"""
+import argparse
+import filecmp
+import itertools
+import json
+import os
+import platform
+import queue
+import re
+import shlex
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from bench_bootstrap import register_many
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FILENAME = "data.bin"
+# Seconds to wait for any expected line of node output
+TIMEOUT = 300
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+class Node:
+    """
+    A bootstrap or peer subprocess. Its output lines are collected with their
+    arrival times, so events can be timed without polling.
+    """
+    def __init__(self, script, args, cwd):
+        self.proc = subprocess.Popen([sys.executable, "-u", os.path.join(ROOT, script)] + [str(a) for a in args],
+                                     cwd=cwd, stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+                                     stderr=subprocess.STDOUT, text=True)
+        self.lines = queue.Queue()
+        threading.Thread(target=self._read, daemon=True).start()
+
+    def _read(self):
+        for line in self.proc.stdout:
+            self.lines.put((time.perf_counter(), line))
+        self.lines.put((time.perf_counter(), None))
+
+    def send(self, command):
+        self.proc.stdin.write(command + "\n")
+        self.proc.stdin.flush()
+
+    def wait_for(self, pattern, timeout=TIMEOUT):
+        """
+        Returns (arrival time, match) for the next output line matching pattern.
+        """
+        deadline = time.monotonic() + timeout
+        while True:
+            arrived, line = self.lines.get(timeout=max(0, deadline - time.monotonic()))
+            if line is None:
+                raise RuntimeError(f"Node exited while waiting for {pattern!r}")
+            match = re.search(pattern, line)
+            if match:
+                return arrived, match
+
+    def cpu_seconds(self):
+        """
+        Returns user plus system CPU time used so far, or None where /proc isn't available.
+        """
+        try:
+            with open(f"/proc/{self.proc.pid}/stat") as f:
+                fields = f.read().rsplit(")", 1)[1].split()
+            return (int(fields[11]) + int(fields[12])) / os.sysconf("SC_CLK_TCK")
+        except (OSError, ValueError, IndexError):
+            return None
+
+    def stop(self):
+        try:
+            self.send("exit")
+        except OSError:
+            pass
+        try:
+            self.proc.wait(timeout=5)
+        except subprocess.TimeoutExpired:
+            self.proc.kill()
+            self.proc.wait()
+
+def make_file(path, size):
+    """
+    Writes size bytes of random data, which neither compresses nor deduplicates.
+    """
+    with open(path, "wb") as f:
+        for start in range(0, size, 8 * 1024 * 1024):
+            f.write(os.urandom(min(8 * 1024 * 1024, size - start)))
+
+def start_peer(workdir, name, bootstrap_port, peer_args, data_path=None):
+    node_dir = os.path.join(workdir, name)
+    os.makedirs(os.path.join(node_dir, "files"))
+    if data_path:
+        os.link(data_path, os.path.join(node_dir, "files", FILENAME))
+    node = Node("peer.py", [free_port(), "--bootstrap", f"127.0.0.1:{bootstrap_port}"] + peer_args, node_dir)
+    node.wait_for("Peer listening")
+    return node
+
+def run_swarm(workdir, data_path, size, chunk_kb, num_seeds, num_leechers, peer_args):
+    """
+    Has num_leechers peers download the file from num_seeds seeds at once and returns the measurements.
+    Seeds share it with chunk_kb KB chunks, or the size they choose if chunk_kb is None.
+    """
+    run_dir = tempfile.mkdtemp(dir=workdir)
+    nodes = []
+    try:
+        bootstrap_port = free_port()
+        bootstrap = Node("bootstrap_server.py", ["--port", bootstrap_port], run_dir)
+        nodes.append(bootstrap)
+        bootstrap.wait_for("listening")
+        seeds = []
+        hash_rates = []
+        seed_args = peer_args + (["--chunk-size", chunk_kb] if chunk_kb else [])
+        for i in range(num_seeds):
+            seed = start_peer(run_dir, f"seed{i}", bootstrap_port, seed_args, data_path)
+            nodes.append(seed)
+            seeds.append(seed)
+            seed.send(f"share {FILENAME}")
+            _, match = seed.wait_for(r"Hashed .* chunks of (\d+) KB\) at ([\d.]+) MB/s")
+            chunk_size_kb = int(match.group(1))
+            hash_rates.append(float(match.group(2)))
+            seed.wait_for("is now shared")
+        leechers = []
+        for i in range(num_leechers):
+            leecher = start_peer(run_dir, f"leecher{i}", bootstrap_port, peer_args)
+            nodes.append(leecher)
+            leechers.append(leecher)
+
+        cpu_before = [seed.cpu_seconds() for seed in seeds]
+        started = time.perf_counter()
+        for leecher in leechers:
+            leecher.send(f"get {FILENAME}")
+        first_chunk = []
+        finished = []
+        for i, leecher in enumerate(leechers):
+            arrived, _ = leecher.wait_for(r"Chunk \d+/\d+ downloaded and verified")
+            first_chunk.append(arrived - started)
+            arrived, match = leecher.wait_for(r"downloaded successfully|again to resume|not found on any peers")
+            if "successfully" not in match.group(0) or not filecmp.cmp(
+                    data_path, os.path.join(run_dir, f"leecher{i}", "files", FILENAME), shallow=False):
+                raise RuntimeError(f"Leecher {i} failed to download the file")
+            finished.append(arrived - started)
+        cpu_after = [seed.cpu_seconds() for seed in seeds]
+
+        delivered_gb = size * num_leechers / 1024 ** 3
+        seed_cpu = None
+        if None not in cpu_before + cpu_after:
+            seed_cpu = sum(after - before for before, after in zip(cpu_before, cpu_after)) / delivered_gb
+        return {
+            "file_mb": size / (1024 * 1024),
+            "chunk_kb": chunk_size_kb,
+            "chunk_size_chosen": chunk_kb is None,
+            "seeds": num_seeds,
+            "leechers": num_leechers,
+            "hash_mb_per_s": sum(hash_rates) / len(hash_rates),
+            "time_to_first_chunk_s": first_chunk,
+            "throughput_mb_per_s": [size / (1024 * 1024) / elapsed for elapsed in finished],
+            "aggregate_mb_per_s": size * num_leechers / (1024 * 1024) / max(finished),
+            "seed_cpu_seconds_per_gb": seed_cpu
+        }
+    finally:
+        for node in reversed(nodes):
+            node.stop()
+
+def measure_registrations(workdir, num_peers, connections):
+    """
+    Returns registrations per second against a fresh bootstrap server.
+    """
+    port = free_port()
+    bootstrap = Node("bootstrap_server.py", ["--port", port], workdir)
+    try:
+        bootstrap.wait_for("listening")
+        per_connection = num_peers // connections
+        threads = [threading.Thread(target=register_many, args=(port, i * per_connection, per_connection))
+                   for i in range(connections)]
+        start = time.perf_counter()
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        return per_connection * connections / (time.perf_counter() - start)
+    finally:
+        bootstrap.proc.terminate()
+        bootstrap.proc.wait()
+
+def run_key(run):
+    return (run["file_mb"], run.get("chunk_kb"), run["seeds"], run["leechers"])
+
+def compare(results, baseline_path):
+    """
+    Prints how each run changed relative to a previous results file.
+    """
+    with open(baseline_path) as f:
+        baseline = json.load(f)
+    previous = {run_key(run): run for run in baseline.get("runs", [])}
+    print(f"Registrations/s: {baseline['registrations_per_second']:.0f} -> {results['registrations_per_second']:.0f}")
+    for run in results["runs"]:
+        old = previous.get(run_key(run))
+        if old is None:
+            continue
+        change = (run["aggregate_mb_per_s"] / old["aggregate_mb_per_s"] - 1) * 100
+        print(f"{run['file_mb']:g} MB in {run['chunk_kb']} KB chunks, {run['seeds']} seed(s), {run['leechers']} leecher(s): "
+              f"{old['aggregate_mb_per_s']:.1f} -> {run['aggregate_mb_per_s']:.1f} MB/s ({change:+.1f}%)")
+
+def main():
+    parser = argparse.ArgumentParser(description="End-to-end loopback benchmark of bootstrap and peers")
+    parser.add_argument("--sizes", default="16,64", help="Comma-separated file sizes in MB (default: 16,64)")
+    parser.add_argument("--chunk-sizes", default="auto",
+                        help="Comma-separated chunk sizes in KB, or 'auto' to let seeds choose (default: auto)")
+    parser.add_argument("--seeds", default="1,2", help="Comma-separated seed counts (default: 1,2)")
+    parser.add_argument("--leechers", default="1,2", help="Comma-separated leecher counts (default: 1,2)")
+    parser.add_argument("--peer-args", default="", help="Extra arguments passed to every peer.py node")
+    parser.add_argument("--registrations", type=int, default=50000, help="Peers registered to time the bootstrap")
+    parser.add_argument("--connections", type=int, default=8, help="Connections used to register them")
+    parser.add_argument("--output", help="Write the JSON results here instead of stdout")
+    parser.add_argument("--compare", help="Previous results file to print changes against")
+    args = parser.parse_args()
+    sizes = [int(float(mb) * 1024 * 1024) for mb in args.sizes.split(",")]
+    chunk_sizes = [None if kb == "auto" else int(kb) for kb in args.chunk_sizes.split(",")]
+    seed_counts = [int(n) for n in args.seeds.split(",")]
+    leecher_counts = [int(n) for n in args.leechers.split(",")]
+    peer_args = shlex.split(args.peer_args)
+
+    results = {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpus": os.cpu_count(),
+        "peer_args": peer_args,
+        "runs": []
+    }
+    with tempfile.TemporaryDirectory() as workdir:
+        results["registrations_per_second"] = measure_registrations(workdir, args.registrations, args.connections)
+        print(f"Bootstrap: {results['registrations_per_second']:.0f} registrations/s", file=sys.stderr)
+        for size in sizes:
+            data_path = os.path.join(workdir, f"data-{size}.bin")
+            make_file(data_path, size)
+            for chunk_kb, num_seeds, num_leechers in itertools.product(chunk_sizes, seed_counts, leecher_counts):
+                run = run_swarm(workdir, data_path, size, chunk_kb, num_seeds, num_leechers, peer_args)
+                results["runs"].append(run)
+                print(f"{run['file_mb']:g} MB in {run['chunk_kb']} KB chunks, {num_seeds} seed(s), {num_leechers} leecher(s): "
+                      f"{run['aggregate_mb_per_s']:.1f} MB/s aggregate, "
+                      f"first chunk after {max(run['time_to_first_chunk_s']) * 1000:.0f} ms", file=sys.stderr)
+            os.remove(data_path)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+    else:
+        print(json.dumps(results, indent=2))
+    if args.compare:
+        compare(results, args.compare)
+
+if __name__ == '__main__':
+    main()
@@ -1,56 +1,394 @@
 #!/usr/bin/env python3
-import socket
-import threading
+"""
+Bootstrap server for peer registration and discovery.
+
+All connections are served by one asyncio event loop, and the peer registry is
+hash-indexed, so registering or looking up a peer costs O(1) however many peers
+are registered. Peers announce the files they share, and who_has answers
+"which peers have X" from an inverted index in one round trip. get_peers replies are paged or randomly sampled and capped at
+MAX_PEERS_PER_REPLY, so reply size doesn't grow with the swarm either.
+Every join or departure bumps a version number and is kept in a change log, so
+clients that cache the peer list refresh it with get_peers_since, receiving only
+the peers added or removed since the version they hold.
+Peers send heartbeats; any peer silent for longer than its TTL is expired,
+so get_peers only returns live peers, most recently seen first.
+Request counts, live peers and connections are kept in the metrics registry and
+served by the stats action.
+
+Target: at least 10,000 registrations per second on a single core over
+persistent loopback connections (`benchmarks/bench_bootstrap.py` measures this).
+"""
+import argparse
+import asyncio
+import heapq
+import itertools
 import json
+import random
+import time
+from collections import OrderedDict
+
+from metrics import REGISTRY
+
+HOST = "0.0.0.0"
+PORT = 8000  # You can change this port if needed
+# Listen backlog and concurrent connection limit
+SERVER_BACKLOG = 1024
+MAX_CONNECTIONS = 10000
+# Longest request line accepted; kept small since every connection may buffer this much
+MAX_REQUEST_SIZE = 1024 * 1024
+# Largest number of peers returned by one get_peers request
+MAX_PEERS_PER_REPLY = 500
+# Seconds a peer stays registered without a heartbeat, and the range peers may ask for
+PEER_TTL = 90
+MIN_PEER_TTL = 10
+MAX_PEER_TTL = 600
+# Seconds between sweeps for expired peers
+EXPIRY_INTERVAL = 1.0
+# Peer joins and departures kept for get_peers_since, and the most returned by one reply
+MAX_CHANGE_LOG = 100000
+MAX_CHANGES_PER_REPLY = 500
+# Peer lists kept for clients paging through a get_peers_since reset
+MAX_RESET_SNAPSHOTS = 4
+# Identifies this run of the server, so versions from before a restart aren't trusted
+EPOCH = f"{random.getrandbits(64):016x}"
+
+class PeerRegistry:
+    """
+    Live peers indexed by (address, port).
+
+    - An OrderedDict keeps peers in recency order, refreshed in O(1) per heartbeat.
+    - A dense key list gives O(1) removal (swap with the last entry) and O(k) random samples.
+    - A heap of deadlines finds expired peers without scanning; stale heap entries
+      left behind by heartbeats are skipped when popped.
+    - Joins and departures bump a version and are appended to a change log, trimmed
+      to MAX_CHANGE_LOG entries, from which changes_since builds deltas.
+    - Full lists for resets are snapshotted per version, so a client paging through
+      one sees every peer exactly once however the registry changes meanwhile.
+    """
+    def __init__(self):
+        self.peers = OrderedDict()  # Format: { (address, port): {"address": ip, "port": port} }, oldest first
+        self.deadlines = {}         # Format: { (address, port): expiry time }
+        self.heap = []              # Format: [(expiry time, (address, port))]
+        self.keys = []              # Dense list of keys for sampling
+        self.slots = {}             # Format: { (address, port): position in self.keys }
+        self.expired_total = 0
+        self.version = 0            # Number of joins and departures so far
+        self.changes = []           # Format: [((address, port), joined)], the change that made version log_start + i + 1
+        self.log_start = 0          # Version just before the oldest change kept
+        self.snapshots = OrderedDict()  # Format: { version: [peers most recently seen first] }, oldest first
+
+    def __len__(self):
+        return len(self.peers)
+
+    def touch(self, address, port, ttl=PEER_TTL):
+        """
+        Registers a peer or refreshes its TTL. Returns False if it was already registered.
+        """
+        key = (address, port)
+        deadline = time.monotonic() + max(MIN_PEER_TTL, min(ttl, MAX_PEER_TTL))
+        self.deadlines[key] = deadline
+        heapq.heappush(self.heap, (deadline, key))
+        if key in self.peers:
+            self.peers.move_to_end(key)
+            return False
+        self.peers[key] = {"address": address, "port": port}
+        self.slots[key] = len(self.keys)
+        self.keys.append(key)
+        self._record(key, True)
+        return True
+
+    def remove(self, key):
+        """
+        Removes a peer. Returns False if it wasn't registered.
+        """
+        if self.peers.pop(key, None) is None:
+            return False
+        del self.deadlines[key]
+        position = self.slots.pop(key)
+        last = self.keys.pop()
+        if position < len(self.keys):
+            self.keys[position] = last
+            self.slots[last] = position
+        self._record(key, False)
+        return True
+
+    def _record(self, key, joined):
+        self.version += 1
+        self.changes.append((key, joined))
+        if len(self.changes) > 2 * MAX_CHANGE_LOG:
+            # Trimmed in bulk so the cost per change stays O(1)
+            dropped = len(self.changes) - MAX_CHANGE_LOG
+            del self.changes[:dropped]
+            self.log_start += dropped
+
+    def changes_since(self, version, limit):
+        """
+        Returns (peers added, peers removed, version reached) for up to limit changes
+        after version, or None if the change log doesn't reach back that far.
+        A peer that joined and left within those changes is only reported once, as it ended.
+        """
+        if not self.log_start <= version <= self.version:
+            return None
+        start = version - self.log_start
+        window = self.changes[start:start + limit]
+        latest = dict(window)
+        added = [{"address": key[0], "port": key[1]} for key, joined in latest.items() if joined]
+        removed = [{"address": key[0], "port": key[1]} for key, joined in latest.items() if not joined]
+        return added, removed, version + len(window)
+
+    def expire(self, now=None):
+        """
+        Removes every peer whose TTL has lapsed and returns their keys.
+        """
+        now = time.monotonic() if now is None else now
+        expired = []
+        while self.heap and self.heap[0][0] <= now:
+            deadline, key = heapq.heappop(self.heap)
+            # Entries superseded by a later heartbeat no longer match
+            if self.deadlines.get(key) == deadline:
+                self.remove(key)
+                expired.append(key)
+        self.expired_total += len(expired)
+        return expired
+
+    def page(self, offset, limit):
+        """
+        Returns peers most recently seen first.
+        """
+        return list(itertools.islice(reversed(self.peers.values()), offset, offset + limit))
+
+    def listing(self, version=None):
+        """
+        Returns (version, every peer at that version) for paging a reset. With no
+        version, or one whose snapshot was dropped, snapshots the current peers.
+        """
+        if version not in self.snapshots:
+            version = self.version
+            if version not in self.snapshots:
+                self.snapshots[version] = list(reversed(self.peers.values()))
+                while len(self.snapshots) > MAX_RESET_SNAPSHOTS:
+                    self.snapshots.popitem(last=False)
+        return version, self.snapshots[version]
+
+    def sample(self, limit):
+        return [self.peers[key] for key in random.sample(self.keys, min(limit, len(self.keys)))]
+
+class ContentIndex:
+    """
+    Inverted index from filename and Merkle root to the peers that announced them,
+    so who_has is answered in one round trip whatever the swarm size.
+    """
+    def __init__(self):
+        self.by_name = {}     # Format: { filename: { (address, port): merkle_root } }
+        self.by_root = {}     # Format: { merkle_root: { (address, port): filename } }
+        self.peer_files = {}  # Format: { (address, port): { filename: merkle_root } }
 
-# Global list of registered peers
-PEERS = []  # Each peer is stored as {"address": ip, "port": port}
-PEERS_LOCK = threading.Lock()
+    def announce(self, key, filename, root):
+        """
+        Records that the peer at key shares filename with the given Merkle root.
+        """
+        files = self.peer_files.setdefault(key, {})
+        if filename in files:
+            self._unlink(key, filename, files[filename])
+        files[filename] = root
+        self.by_name.setdefault(filename, {})[key] = root
+        if root:
+            self.by_root.setdefault(root, {})[key] = filename
 
-def handle_client(conn, addr):
+    def withdraw(self, key, filename):
+        """
+        Drops one file the peer at key announced, e.g. a download it abandoned.
+        """
+        files = self.peer_files.get(key, {})
+        if filename in files:
+            self._unlink(key, filename, files.pop(filename))
+        if not files:
+            self.peer_files.pop(key, None)
+
+    def remove_peer(self, key):
+        """
+        Drops every file the peer at key announced.
+        """
+        for filename, root in self.peer_files.pop(key, {}).items():
+            self._unlink(key, filename, root)
+
+    def _unlink(self, key, filename, root):
+        holders = self.by_name.get(filename, {})
+        holders.pop(key, None)
+        if not holders:
+            self.by_name.pop(filename, None)
+        if root:
+            holders = self.by_root.get(root, {})
+            holders.pop(key, None)
+            if not holders:
+                self.by_root.pop(root, None)
+
+    def who_has(self, filename=None, root=None, limit=MAX_PEERS_PER_REPLY):
+        """
+        Returns up to limit peers holding the file, as dicts with the root they announced.
+        """
+        if root:
+            holders = [(key, root) for key in self.by_root.get(root, {})]
+        else:
+            holders = list(self.by_name.get(filename, {}).items())
+        if len(holders) > limit:
+            holders = random.sample(holders, limit)
+        return [{"address": key[0], "port": key[1], "merkle_root": holder_root} for key, holder_root in holders]
+
+# Global registry of peers and the files they share; only touched from the event loop thread
+PEERS = PeerRegistry()
+CONTENT = ContentIndex()
+
+# Requests served per action, created up front so clients can't add metrics with made-up actions
+ACTIONS = ("register", "heartbeat", "get_peers", "get_peers_since", "announce", "unannounce", "who_has", "stats")
+REQUEST_COUNTERS = {action: REGISTRY.counter("requests", f"action={action}") for action in ACTIONS}
+UNKNOWN_REQUESTS = REGISTRY.counter("requests", "action=unknown")
+EXPIRED_COUNTER = REGISTRY.counter("peers_expired")
+PEERS_GAUGE = REGISTRY.gauge("peers")
+FILES_GAUGE = REGISTRY.gauge("files_indexed")
+CONNECTIONS_GAUGE = REGISTRY.gauge("active_connections")
+
+def handle_message(message):
+    """
+    Returns the reply to one request.
+    """
+    action = message.get("action")
+    REQUEST_COUNTERS.get(action, UNKNOWN_REQUESTS).inc()
+    if action == "register":
+        address = message.get("address")
+        port = message.get("port")
+        if PEERS.touch(address, port, message.get("ttl", PEER_TTL)):
+            print(f"Registered peer: {address}:{port}")
+        # Acknowledge registration
+        return {"status": "registered", "ttl": PEER_TTL}
+    elif action == "heartbeat":
+        address = message.get("address")
+        port = message.get("port")
+        new = PEERS.touch(address, port, message.get("ttl", PEER_TTL))
+        if new:
+            print(f"Registered peer: {address}:{port}")
+        # An unknown peer expired or this server restarted, so it should announce its files again
+        return {"status": "alive", "known": not new}
+    elif action == "get_peers":
+        # Sweep first so a reply never lists a peer whose TTL has just lapsed
+        expire_peers()
+        limit = max(0, min(message.get("limit", MAX_PEERS_PER_REPLY), MAX_PEERS_PER_REPLY))
+        if message.get("sample"):
+            # A random subset spreads downloaders across the swarm
+            peers = PEERS.sample(limit)
+        else:
+            peers = PEERS.page(max(0, message.get("offset", 0)), limit)
+        return {"peers": peers, "total": len(PEERS), "expired": PEERS.expired_total}
+    elif action == "get_peers_since":
+        expire_peers()
+        since = message.get("since")
+        delta = None
+        if message.get("epoch") == EPOCH and isinstance(since, int):
+            delta = PEERS.changes_since(since, MAX_CHANGES_PER_REPLY)
+        if delta is None:
+            # No version yet, one from before a restart, or one older than the log: start over from a full list,
+            # paged from a snapshot so the pages add up to the list at one version
+            version, peers = PEERS.listing(message.get("version"))
+            offset = message.get("offset", 0)
+            if version != message.get("version") or not isinstance(offset, int) or offset < 0:
+                offset = 0
+            page = peers[offset:offset + MAX_PEERS_PER_REPLY]
+            return {"reset": True, "peers": page, "version": version, "offset": offset,
+                    "more": offset + len(page) < len(peers), "epoch": EPOCH, "total": len(peers)}
+        added, removed, version = delta
+        return {"added": added, "removed": removed, "version": version, "more": version < PEERS.version,
+                "epoch": EPOCH, "total": len(PEERS)}
+    elif action == "announce":
+        address = message.get("address")
+        port = message.get("port")
+        # Announcing implies being reachable, so make sure the peer is registered too
+        PEERS.touch(address, port, message.get("ttl", PEER_TTL))
+        for entry in message.get("files", []):
+            CONTENT.announce((address, port), entry.get("filename"), entry.get("merkle_root"))
+        return {"status": "announced"}
+    elif action == "unannounce":
+        for filename in message.get("filenames", []):
+            CONTENT.withdraw((message.get("address"), message.get("port")), filename)
+        return {"status": "unannounced"}
+    elif action == "who_has":
+        limit = max(0, min(message.get("limit", MAX_PEERS_PER_REPLY), MAX_PEERS_PER_REPLY))
+        peers = CONTENT.who_has(message.get("filename"), message.get("merkle_root"), limit)
+        return {"peers": peers}
+    elif action == "stats":
+        update_gauges()
+        return {"status": "ok", "metrics": REGISTRY.snapshot()}
+    return {"status": "error", "message": f"Unknown action: {action}"}
+
+def update_gauges():
+    PEERS_GAUGE.set(len(PEERS))
+    FILES_GAUGE.set(len(CONTENT.by_name))
+
+def expire_peers():
+    """
+    Drops peers whose TTL lapsed, along with the files they announced.
+    """
+    expired = PEERS.expire()
+    for key in expired:
+        CONTENT.remove_peer(key)
+    EXPIRED_COUNTER.inc(len(expired))
+    if expired:
+        print(f"Expired {len(expired)} peer(s) (active: {len(PEERS)}, expired total: {PEERS.expired_total})")
+
+async def expiry_loop():
+    while True:
+        await asyncio.sleep(EXPIRY_INTERVAL)
+        expire_peers()
+        update_gauges()
+
+async def handle_client(reader, writer):
+    """
+    Serves newline-delimited JSON requests until the client closes the connection.
+    """
+    addr = writer.get_extra_info("peername")
+    CONNECTIONS_GAUGE.inc()
     try:
-        # Use a file-like object to read/write JSON lines
-        file = conn.makefile(mode='rw')
-        line = file.readline()
-        if not line:
-            return
-        message = json.loads(line.strip())
-        action = message.get("action")
-        if action == "register":
-            peer_info = {"address": message.get("address"), "port": message.get("port")}
-            with PEERS_LOCK:
-                if peer_info not in PEERS:
-                    PEERS.append(peer_info)
-                    print(f"Registered peer: {peer_info}")
-            # Acknowledge registration
-            response = {"status": "registered"}
-            file.write(json.dumps(response) + "\n")
-            file.flush()
-        elif action == "get_peers":
-            with PEERS_LOCK:
-                response = {"peers": PEERS}
-            file.write(json.dumps(response) + "\n")
-            file.flush()
+        while True:
+            line = await reader.readline()
+            if not line:
+                break
+            response = handle_message(json.loads(line))
+            writer.write((json.dumps(response) + "\n").encode())
+            await writer.drain()
     except Exception as e:
         print(f"Error handling client {addr}: {e}")
     finally:
-        conn.close()
+        CONNECTIONS_GAUGE.dec()
+        writer.close()
+
+async def serve(host, port, max_connections, backlog):
+    slots = asyncio.Semaphore(max_connections)
+
+    async def on_connect(reader, writer):
+        async with slots:
+            await handle_client(reader, writer)
+
+    server = await asyncio.start_server(on_connect, host, port, backlog=backlog, limit=MAX_REQUEST_SIZE)
+    print(f"Bootstrap server listening on {host}:{port}")
+    # Keep a reference so the sweeper task isn't garbage collected
+    expiry = asyncio.create_task(expiry_loop())
+    async with server:
+        await server.serve_forever()
 
 def main():
-    HOST = "0.0.0.0"
-    PORT = 8000  # You can change this port if needed
-    server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-    server.bind((HOST, PORT))
-    server.listen(5)
-    print(f"Bootstrap server listening on {HOST}:{PORT}")
+    parser = argparse.ArgumentParser(description="P2P bootstrap server")
+    parser.add_argument("--port", type=int, default=PORT, help=f"Port to listen on (default: {PORT})")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Client connections served at once; extra connections wait")
+    parser.add_argument("--backlog", type=int, default=SERVER_BACKLOG, help="Listen backlog")
+    parser.add_argument("--metrics-file", help="Write a JSON snapshot of the metrics to this file periodically")
+    parser.add_argument("--metrics-interval", type=float, default=10, help="Seconds between metrics snapshots (default: 10)")
+    args, _ = parser.parse_known_args()
+    if args.metrics_file:
+        REGISTRY.start_dump(args.metrics_file, args.metrics_interval)
     try:
-        while True:
-            conn, addr = server.accept()
-            threading.Thread(target=handle_client, args=(conn, addr), daemon=True).start()
+        asyncio.run(serve(HOST, args.port, args.max_connections, args.backlog))
     except KeyboardInterrupt:
         print("Shutting down bootstrap server.")
-    finally:
-        server.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,159 @@
+#!/usr/bin/env python3
+"""
+In-process metrics shared by the peer and the bootstrap server: counters, gauges
+and fixed-bucket histograms. Metrics are created once and kept as module-level
+objects by their users, so recording one on the hot path is a lock and an add.
+A snapshot of everything is served by the `stats` action, printed by `status`
+and can be dumped to a JSON file periodically.
+"""
+import bisect
+import json
+import os
+import threading
+import time
+
+# Histogram bucket upper bounds in seconds: 0.5ms doubling up to about 16s
+LATENCY_BUCKETS = [0.0005 * 2 ** i for i in range(16)]
+# Bucket bounds for slow operations such as hashing a whole file: 10ms up to about 5 minutes
+DURATION_BUCKETS = [0.01 * 2 ** i for i in range(16)]
+
+class Counter:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def snapshot(self):
+        return self.value
+
+class Gauge:
+    def __init__(self):
+        self.value = 0
+        self.lock = threading.Lock()
+
+    def inc(self, amount=1):
+        with self.lock:
+            self.value += amount
+
+    def dec(self, amount=1):
+        with self.lock:
+            self.value -= amount
+
+    def set(self, value):
+        self.value = value
+
+    def snapshot(self):
+        return self.value
+
+class Histogram:
+    """
+    Counts observations into fixed buckets; percentiles are estimated as the
+    upper bound of the bucket they fall in.
+    """
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.bounds = list(buckets)
+        self.counts = [0] * (len(self.bounds) + 1)  # The last bucket holds values above every bound
+        self.count = 0
+        self.sum = 0.0
+        self.lock = threading.Lock()
+
+    def observe(self, value):
+        position = bisect.bisect_left(self.bounds, value)
+        with self.lock:
+            self.counts[position] += 1
+            self.count += 1
+            self.sum += value
+
+    def percentile(self, fraction):
+        with self.lock:
+            return self._percentile(fraction)
+
+    def _percentile(self, fraction):
+        if not self.count:
+            return None
+        target = fraction * self.count
+        seen = 0
+        for position, count in enumerate(self.counts):
+            seen += count
+            if seen >= target:
+                return self.bounds[min(position, len(self.bounds) - 1)]
+        return self.bounds[-1]
+
+    def snapshot(self):
+        with self.lock:
+            return {
+                "count": self.count,
+                "sum": self.sum,
+                "p50": self._percentile(0.5),
+                "p95": self._percentile(0.95),
+                "p99": self._percentile(0.99),
+                "buckets": {f"{bound:g}": count for bound, count in zip(self.bounds + ["+Inf"], self.counts) if count}
+            }
+
+class MetricsRegistry:
+    """
+    Named metrics, optionally labelled (e.g. per peer). Asking for the same name
+    and label again returns the same metric.
+    """
+    def __init__(self):
+        self.metrics = {}  # Format: { "name" or "name{label}": Counter | Gauge | Histogram }
+        self.started = time.time()
+        self.lock = threading.Lock()
+
+    def _get(self, cls, name, label, *args):
+        key = f"{name}{{{label}}}" if label else name
+        with self.lock:
+            metric = self.metrics.get(key)
+            if metric is None:
+                metric = self.metrics[key] = cls(*args)
+            return metric
+
+    def counter(self, name, label=None):
+        return self._get(Counter, name, label)
+
+    def gauge(self, name, label=None):
+        return self._get(Gauge, name, label)
+
+    def histogram(self, name, label=None, buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, label, buckets)
+
+    def snapshot(self):
+        """
+        Returns every metric as JSON-serializable data, grouped by kind.
+        """
+        with self.lock:
+            metrics = list(self.metrics.items())
+        result = {"uptime": time.time() - self.started, "counters": {}, "gauges": {}, "histograms": {}}
+        for key, metric in metrics:
+            kind = "counters" if isinstance(metric, Counter) else "gauges" if isinstance(metric, Gauge) else "histograms"
+            result[kind][key] = metric.snapshot()
+        return result
+
+    def dump(self, path):
+        """
+        Atomically writes a snapshot to path as JSON.
+        """
+        temp_path = path + ".tmp"
+        with open(temp_path, "w") as f:
+            json.dump(self.snapshot(), f, indent=2)
+        os.replace(temp_path, path)
+
+    def start_dump(self, path, interval):
+        """
+        Rewrites path with a fresh snapshot every interval seconds from a daemon thread.
+        """
+        def dump_loop():
+            while True:
+                time.sleep(interval)
+                try:
+                    self.dump(path)
+                except OSError as e:
+                    print(f"Error writing metrics to {path}: {e}")
+
+        threading.Thread(target=dump_loop, daemon=True).start()
+
+# Registry shared by everything in this process
+REGISTRY = MetricsRegistry()
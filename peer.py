@@ -1,219 +1,2542 @@
 #!/usr/bin/env python3
+import argparse
+import asyncio
+import itertools
 import socket
 import threading
 import json
 import os
-import sys
+import random
 import time
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 
-from utils import send_json, recv_json, CHUNK_SIZE, split_file, verify_chunk, encode_chunk, decode_chunk, ensure_files_dir
+from utils import (send_json, recv_json, CHUNK_SIZE, MAX_CHUNK_SIZE, choose_chunk_size, hash_file_timed, verify_chunk, encode_chunk, decode_chunk,
+                   collection_root,
+                   CODECS, compress_chunk, decompress_chunk, ensure_files_dir, ChunkBitmap, preallocate, read_at, write_at, send_file_range,
+                   send_frame, pack_frame_header, MessageReader, MAX_MESSAGE_SIZE,
+                   merkle_root, merkle_levels, merkle_range_proof, verify_merkle_range, FRAME_CHUNK, FRAME_ERROR)
+from metrics import REGISTRY, DURATION_BUCKETS
 
 # Bootstrap server details (adjust if the server runs on a different host)
 BOOTSTRAP_SERVER = ("127.0.0.1", 8000)
 
+# Seconds between heartbeats to the bootstrap server (it expires peers after 90s of silence)
+HEARTBEAT_INTERVAL = 30
+# Seconds the cached peer list is used before it is refreshed from the bootstrap server
+PEER_CACHE_TTL = 30
+# Peer exchange: seconds between rounds, peers contacted per round, peers sent per message,
+# and the most peers learned this way that are remembered, each for at most PEX_PEER_TTL seconds
+PEX_INTERVAL = 30
+PEX_FANOUT = 3
+PEX_SAMPLE = 50
+MAX_PEX_PEERS = 500
+PEX_PEER_TTL = 600
+# Number of get_chunk requests kept outstanding on one persistent peer connection
+# before its throughput is known, and the bounds once it is
+PIPELINE_WINDOW = 16
+MIN_PIPELINE_WINDOW = 4
+MAX_PIPELINE_WINDOW = 128
+# Outstanding chunks at or below which idle peers duplicate requests (endgame mode)
+ENDGAME_CHUNKS = 8
+# Peers a chunk is requested from at once in endgame mode
+ENDGAME_COPIES = 2
+# Connections opened to each seeding peer during a swarm download
+WORKERS_PER_PEER = 2
+# Verification failures tolerated per chunk before a download is aborted
+MAX_CHUNK_ATTEMPTS = 3
+# Chunks, and bytes of chunk data, requested by one get_batch when downloading a collection
+BATCH_CHUNKS = 256
+BATCH_BYTES = 1024 * 1024
+# get_batch requests kept outstanding on one connection
+BATCH_WINDOW = 4
+# Seconds between checkpoints of a download's chunk bitmap
+STATE_SAVE_INTERVAL = 1.0
+# Largest range of chunk hashes returned by one get_hashes request
+MAX_HASH_RANGE = 4096
+# Chunk hashes fetched per get_hashes request by a downloader
+HASH_RANGE_SIZE = 1024
+# Listen backlog and concurrent connection limit of the peer server
+SERVER_BACKLOG = 128
+MAX_CONNECTIONS = 1024
+# Seconds a peer connection may sit idle between requests before the server closes it
+IDLE_TIMEOUT = 300
+# Threads used for blocking disk reads by the asyncio server
+ASYNC_IO_THREADS = 16
+# Served files whose handles are kept open across get_chunk requests
+MAX_OPEN_FILES = 64
+# Lets the kernel coalesce a frame header with the sendfile payload that follows
+MSG_MORE = getattr(socket, "MSG_MORE", 0)
+# Memory budget in bytes for recently served chunks (0 disables the cache)
+CHUNK_CACHE_BYTES = 64 * 1024 * 1024
+# Files named per announce request, so each stays well under the bootstrap server's request size limit
+ANNOUNCE_BATCH = 500
+# Upload limits in bytes per second for all peers together and for each peer (0 = unlimited),
+# and the number of chunks sent at once, in all and to one peer; requests beyond that wait their turn peer by peer
+UPLOAD_RATE = 0
+PEER_UPLOAD_RATE = 0
+UPLOAD_SLOTS = 8
+PEER_UPLOAD_SLOTS = 4
+# Seconds a send to a peer may block before its connection is dropped, so one that stops reading frees its slot
+SEND_TIMEOUT = 30
+# Seconds of unused upload allowance a rate limit lets accumulate
+UPLOAD_BURST = 0.25
+# Sidecar index that keeps share manifests across restarts, and seconds between writes of it
+MANIFEST_INDEX = os.path.join("files", ".manifests.json")
+MANIFEST_SAVE_INTERVAL = 1.0
+
 # Local dictionaries for shared files and ongoing transfers
-shared_files = {}  # Format: { filename: { "num_chunks": int, "chunk_hashes": [...] } }
-transfers = {}     # Placeholder for transfer status tracking
+shared_files = {}  # Format: { filename: { "file_size": int, "chunk_size": int, "num_chunks": int, "chunk_hashes": [...] } }
+transfers = {}     # Format: { filename: { "status": str, "chunks_done": int, "num_chunks": int } }
+local_peer = None  # Format: { "address": ip, "port": port } once registered
+active_downloads = {}  # Format: { filename: { "state": DownloadState, "temp_path": str } }
+shared_collections = {}  # Format: { name: { "merkle_root": str, "files": [ { "path", "file_size", "chunk_size", "chunk_hashes" } ] } }
+collection_members = {}  # Format: { "name/path": manifest } for every file of a shared collection
+dedup_enabled = True   # Copy chunks already held locally instead of fetching them (--no-dedup turns this off)
+preferred_codec = None  # Codec asked of seeds that support it (--codec), None for uncompressed chunks
+share_chunk_size = None  # Chunk size for newly shared files (--chunk-size), None to pick one per file
 
-def register_with_bootstrap(my_address, my_port):
+# Process-wide metrics, looked up once so recording them on the hot path stays cheap
+bytes_in_counter = REGISTRY.counter("bytes_in")
+bytes_out_counter = REGISTRY.counter("bytes_out")
+verified_counter = REGISTRY.counter("chunks_verified")
+failed_counter = REGISTRY.counter("chunks_failed")
+served_counter = REGISTRY.counter("chunks_served")
+connections_gauge = REGISTRY.gauge("active_connections")
+hash_histogram = REGISTRY.histogram("hash_seconds", buckets=DURATION_BUCKETS)
+directory_hits_counter = REGISTRY.counter("peer_directory_hits")
+directory_refresh_counter = REGISTRY.counter("peer_directory_refreshes")
+pex_counter = REGISTRY.counter("pex_exchanges")
+
+class ManifestCache:
     """
-    Registers this peer with the bootstrap server.
+    Chunk manifests of shared files keyed by path. Each entry is stamped with the
+    file's size, mtime and inode; a changed stamp means the file is re-hashed.
+    Entries are persisted to MANIFEST_INDEX so restarts don't re-hash either; changes
+    are written by a background flush every MANIFEST_SAVE_INTERVAL seconds, or by
+    save(), and serialized outside the lock so lookups never wait for the disk.
+
+    The manifests also form a content-addressed index of every chunk held locally:
+    chunk hash -> (path, chunk index), which find_chunk uses to deduplicate downloads.
+    """
+    def __init__(self, index_path):
+        self.index_path = index_path
+        self.entries = None  # Format: { path: { "stamp": [size, mtime_ns, inode], "manifest": {...} } }
+        self.trees = {}      # Format: { path: (merkle_root, levels) }
+        self.by_hash = {}    # Format: { chunk hash: (path, chunk index) }
+        self.dirty = False   # Entries changed since the index was last written
+        self.flusher = None
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+
+    def _load(self):
+        try:
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        except (OSError, ValueError):
+            self.entries = {}
+        for file_path, entry in self.entries.items():
+            self._index(file_path, entry["manifest"])
+
+    def _index(self, file_path, manifest):
+        for chunk_index, chunk_hash in enumerate(manifest["chunk_hashes"]):
+            self.by_hash[chunk_hash] = (file_path, chunk_index)
+
+    def _flush_loop(self):
+        while True:
+            time.sleep(MANIFEST_SAVE_INTERVAL)
+            try:
+                self.save()
+            except OSError as e:
+                print(f"Error saving manifest index: {e}")
+
+    def get(self, file_path, chunk_size=None, batch=False):
+        """
+        Returns the manifest for file_path, hashing the file only if it changed.
+        Without a chunk_size, an unchanged file keeps the chunk size it was indexed
+        with (a download keeps its seed's) and a changed one gets choose_chunk_size.
+        With batch, as for each file of a collection, nothing is printed.
+        Returns None if the file does not exist.
+        """
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None
+        stamp = [st.st_size, st.st_mtime_ns, st.st_ino]
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            entry = self.entries.get(file_path)
+            if (entry and entry["stamp"] == stamp and chunk_size in (None, entry["manifest"]["chunk_size"])
+                    and "merkle_root" in entry["manifest"]):
+                return entry["manifest"]
+        chunk_size = chunk_size or choose_chunk_size(st.st_size)
+        started = time.monotonic()
+        chunk_hashes, rate = hash_file_timed(file_path, chunk_size)
+        hash_histogram.observe(time.monotonic() - started)
+        if not batch:
+            print(f"Hashed '{file_path}': {st.st_size / (1024 * 1024):.1f} MB ({len(chunk_hashes)} chunks of "
+                  f"{chunk_size // 1024} KB) at {rate / (1024 * 1024):.1f} MB/s.")
+        manifest = {
+            "file_size": st.st_size,
+            "chunk_size": chunk_size,
+            "num_chunks": len(chunk_hashes),
+            "chunk_hashes": chunk_hashes,
+            "merkle_root": merkle_root(chunk_hashes)
+        }
+        self._store(file_path, stamp, manifest)
+        return manifest
+
+    def _store(self, file_path, stamp, manifest):
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            self.entries[file_path] = {"stamp": stamp, "manifest": manifest}
+            self._index(file_path, manifest)
+            self.dirty = True
+            if self.flusher is None:
+                self.flusher = threading.Thread(target=self._flush_loop, daemon=True)
+                self.flusher.start()
+
+    def add(self, file_path, chunk_hashes, chunk_size):
+        """
+        Records the manifest of a file whose hashes are already known, e.g. a
+        finished download, so it is indexed and shared without re-hashing.
+        """
+        st = os.stat(file_path)
+        self._store(file_path, [st.st_size, st.st_mtime_ns, st.st_ino], {
+            "file_size": st.st_size,
+            "chunk_size": chunk_size,
+            "num_chunks": len(chunk_hashes),
+            "chunk_hashes": chunk_hashes,
+            "merkle_root": merkle_root(chunk_hashes)
+        })
+
+    def save(self):
+        """
+        Writes the index now if it changed, e.g. after a batch of get or add calls.
+        """
+        with self.save_lock:
+            with self.lock:
+                if not self.dirty:
+                    return
+                # Manifests are replaced, never changed in place, so a shallow copy is a stable snapshot
+                entries = dict(self.entries)
+                self.dirty = False
+            temp_path = self.index_path + ".tmp"
+            try:
+                with open(temp_path, "w") as f:
+                    json.dump(entries, f)
+                os.replace(temp_path, self.index_path)
+            except OSError:
+                with self.lock:
+                    self.dirty = True
+                raise
+
+    def find_chunk(self, chunk_hash):
+        """
+        Returns the data of a chunk with this hash from any local file, or None.
+        The data is re-verified, so a file that changed since it was indexed is never trusted.
+        """
+        with self.lock:
+            if self.entries is None:
+                self._load()
+            location = self.by_hash.get(chunk_hash)
+            if location is None:
+                return None
+            file_path, chunk_index = location
+            chunk_size = self.entries[file_path]["manifest"]["chunk_size"]
+        f, file_size, _ = file_handles.get(file_path)
+        offset = chunk_index * chunk_size
+        if f is None or offset >= file_size:
+            return None
+        data = read_at(f.fileno(), offset, min(chunk_size, file_size - offset))
+        return data if verify_chunk(data, chunk_hash) else None
+
+    def merkle_levels(self, file_path, manifest):
+        """
+        Returns the Merkle tree for a file's manifest, built on first use and kept in memory.
+        """
+        with self.lock:
+            root, levels = self.trees.get(file_path, (None, None))
+        if root != manifest["merkle_root"]:
+            levels = merkle_levels(manifest["chunk_hashes"])
+            with self.lock:
+                self.trees[file_path] = (manifest["merkle_root"], levels)
+        return levels
+
+manifest_cache = ManifestCache(MANIFEST_INDEX)
+
+class FileHandleCache:
+    """
+    Open read-only handles of served files, shared by all connection handlers so a
+    file is opened once rather than per get_chunk. A handle is reopened when the file
+    is replaced or changes size; handlers still using the old one keep it alive.
+    """
+    def __init__(self, max_open=MAX_OPEN_FILES):
+        self.max_open = max_open
+        self.handles = OrderedDict()  # Format: { path: (file object, stamp) }
+        self.lock = threading.Lock()
+
+    def get(self, file_path):
+        """
+        Returns (file object, file size, stamp) for file_path, or (None, 0, None) if it
+        doesn't exist. The stamp (path, inode, size, mtime) identifies this version
+        of the file without keeping its handle open.
+        """
+        try:
+            st = os.stat(file_path)
+        except OSError:
+            return None, 0, None
+        stamp = (file_path, st.st_ino, st.st_size, st.st_mtime_ns)
+        with self.lock:
+            entry = self.handles.get(file_path)
+            if entry and entry[1] == stamp:
+                self.handles.move_to_end(file_path)
+                return entry[0], st.st_size, stamp
+        f = open(file_path, "rb", buffering=0)
+        with self.lock:
+            replaced = file_path in self.handles
+            self.handles[file_path] = (f, stamp)
+            self.handles.move_to_end(file_path)
+            while len(self.handles) > self.max_open:
+                # Evicted handles close once no handler references them any more
+                self.handles.popitem(last=False)
+        if replaced:
+            # The file changed on disk, so chunks cached from the old handle are stale
+            chunk_cache.invalidate(file_path)
+        return f, st.st_size, stamp
+
+file_handles = FileHandleCache()
+
+class ChunkCache:
+    """
+    Byte-budgeted LRU of recently served chunks, shared by all connection handlers.
+    Entries are keyed by (file stamp, offset, codec); a compressed entry holds the
+    payload sent for that codec, which is the raw chunk if it didn't compress.
+    The stamp from FileHandleCache changes when the file does, so old chunks are
+    never served, and no file handle is kept open by the cache; FileHandleCache
+    also drops a changed file's chunks at once to free the memory.
+
+    A chunk is only admitted on its second miss among recent misses, so a single
+    pass over a cold file keeps going through sendfile and doesn't flush hot chunks.
+    """
+    def __init__(self, max_bytes=CHUNK_CACHE_BYTES):
+        self.max_bytes = max_bytes
+        self.entries = OrderedDict()  # Format: { (stamp, offset, codec): bytes }, least recently used first
+        self.seen = OrderedDict()     # Format: { (stamp, offset, codec): None }, recent misses not yet admitted
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, stamp, offset, codec=None):
+        """
+        Returns (data, admit): the cached chunk or None, and on a miss whether the
+        caller should read the chunk and put() it.
+        """
+        if not self.max_bytes:
+            return None, False
+        key = (stamp, offset, codec)
+        with self.lock:
+            data = self.entries.get(key)
+            if data is not None:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return data, False
+            self.misses += 1
+            if key in self.seen:
+                del self.seen[key]
+                return None, True
+            self.seen[key] = None
+            while len(self.seen) > self.max_bytes // CHUNK_SIZE:
+                self.seen.popitem(last=False)
+            return None, False
+
+    def put(self, stamp, offset, data, codec=None):
+        if len(data) > self.max_bytes:
+            return
+        key = (stamp, offset, codec)
+        with self.lock:
+            if key in self.entries:
+                return
+            self.entries[key] = data
+            self.size += len(data)
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+
+    def invalidate(self, file_path):
+        """
+        Drops every chunk cached from file_path.
+        """
+        with self.lock:
+            for key in [key for key in self.entries if key[0][0] == file_path]:
+                self.size -= len(self.entries.pop(key))
+            for key in [key for key in self.seen if key[0][0] == file_path]:
+                del self.seen[key]
+
+    def resize(self, max_bytes):
+        with self.lock:
+            self.max_bytes = max_bytes
+            while self.size > self.max_bytes:
+                _, evicted = self.entries.popitem(last=False)
+                self.size -= len(evicted)
+                self.evictions += 1
+            if not max_bytes:
+                self.seen.clear()
+
+    def snapshot(self):
+        """
+        Returns (bytes cached, budget, hits, misses, evictions).
+        """
+        with self.lock:
+            return self.size, self.max_bytes, self.hits, self.misses, self.evictions
+
+chunk_cache = ChunkCache()
+
+class TokenBucket:
+    """
+    Rate limiter that lets the balance go negative: a send is never split, and the
+    sender waits until the debt it ran up is repaid. A rate of 0 means unlimited.
+    Not locked; UploadLimiter serializes access.
+    """
+    def __init__(self, rate):
+        self.rate = rate
+        self.tokens = 0
+        self.updated = time.monotonic()
+
+    def reserve(self, nbytes):
+        """
+        Takes nbytes from the bucket and returns the seconds to wait before sending them.
+        """
+        if not self.rate:
+            return 0
+        now = time.monotonic()
+        burst = max(self.rate * UPLOAD_BURST, CHUNK_SIZE)
+        self.tokens = min(burst, self.tokens + (now - self.updated) * self.rate) - nbytes
+        self.updated = now
+        return max(0, -self.tokens / self.rate)
+
+class UploadLimiter:
+    """
+    Upload slots, rate limits and per-peer counters for the serving side.
+
+    - At most `slots` chunks are sent at once, and at most `peer_slots` to one peer.
+      Waiting requests are queued per peer and slots are granted round-robin across
+      peers, so a leecher with many pipelined requests or connections can't crowd out the others.
+    - A global and a per-peer token bucket cap the upload rate.
+    Peers are keyed by remote address. All limits can be changed while running.
+    """
+    def __init__(self, rate=UPLOAD_RATE, peer_rate=PEER_UPLOAD_RATE, slots=UPLOAD_SLOTS, peer_slots=PEER_UPLOAD_SLOTS):
+        self.bucket = TokenBucket(rate)
+        self.peer_rate = peer_rate
+        self.slots = slots
+        self.peer_slots = peer_slots
+        self.active = 0
+        self.peers = {}              # Format: { address: { "bucket": TokenBucket, "served": bytes, "queued": int, "active": int } }
+        self.waiting = OrderedDict()  # Format: { address: deque of grant callbacks }, in round-robin order
+        self.lock = threading.Lock()
+
+    def _peer(self, peer):
+        entry = self.peers.get(peer)
+        if entry is None:
+            entry = self.peers[peer] = {"bucket": TokenBucket(self.peer_rate), "served": 0, "queued": 0, "active": 0}
+        return entry
+
+    def _dispatch(self):
+        """
+        Hands free slots to waiting peers in turn. Returns the grant callbacks to call.
+        """
+        granted = []
+        while not self.slots or self.active < self.slots:
+            # The next peer in turn that isn't already using all the slots it may hold
+            peer = next((peer for peer in self.waiting
+                         if not self.peer_slots or self.peers[peer]["active"] < self.peer_slots), None)
+            if peer is None:
+                break
+            queue = self.waiting[peer]
+            granted.append(queue.popleft())
+            if queue:
+                self.waiting.move_to_end(peer)
+            else:
+                del self.waiting[peer]
+            entry = self.peers[peer]
+            entry["queued"] -= 1
+            entry["active"] += 1
+            self.active += 1
+        return granted
+
+    def acquire(self, peer, grant):
+        """
+        Calls grant() once peer holds an upload slot, right away if one is free.
+        """
+        with self.lock:
+            self._peer(peer)["queued"] += 1
+            self.waiting.setdefault(peer, deque()).append(grant)
+            granted = self._dispatch()
+        for callback in granted:
+            callback()
+
+    def wait(self, peer):
+        """
+        Blocks until peer holds an upload slot.
+        """
+        ready = threading.Event()
+        self.acquire(peer, ready.set)
+        ready.wait()
+
+    def throttle(self, peer, nbytes):
+        """
+        Charges nbytes to the global and per-peer limits and returns the seconds to wait before sending.
+        """
+        with self.lock:
+            return max(self.bucket.reserve(nbytes), self._peer(peer)["bucket"].reserve(nbytes))
+
+    def release(self, peer, nbytes):
+        """
+        Frees peer's slot after it was sent nbytes.
+        """
+        with self.lock:
+            entry = self.peers[peer]
+            entry["served"] += nbytes
+            entry["active"] -= 1
+            self.active -= 1
+            granted = self._dispatch()
+        for callback in granted:
+            callback()
+
+    def set_limits(self, rate=None, peer_rate=None, slots=None, peer_slots=None):
+        with self.lock:
+            if rate is not None:
+                self.bucket.rate = rate
+            if peer_rate is not None:
+                self.peer_rate = peer_rate
+                for entry in self.peers.values():
+                    entry["bucket"].rate = peer_rate
+            if slots is not None:
+                self.slots = slots
+            if peer_slots is not None:
+                self.peer_slots = peer_slots
+            granted = self._dispatch()
+        for callback in granted:
+            callback()
+
+    def snapshot(self):
+        """
+        Returns the current limits and { address: (bytes served, requests queued, chunks being sent) }.
+        """
+        with self.lock:
+            peers = {peer: (entry["served"], entry["queued"], entry["active"]) for peer, entry in self.peers.items()}
+            return self.bucket.rate, self.peer_rate, self.slots, peers
+
+uploads = UploadLimiter()
+
+def bootstrap_request(message):
     """
+    Sends one request to the bootstrap server and returns its reply (None if it sent none).
+    """
+    s = socket.create_connection(BOOTSTRAP_SERVER, timeout=10)
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(BOOTSTRAP_SERVER)
-        message = {"action": "register", "address": my_address, "port": my_port}
         send_json(s, message)
-        response = recv_json(s)
+        return recv_json(s)
+    finally:
         s.close()
+
+def register_with_bootstrap(my_address, my_port):
+    """
+    Registers this peer with the bootstrap server.
+    """
+    global local_peer
+    first_registration = local_peer is None
+    local_peer = {"address": my_address, "port": my_port}
+    try:
+        response = bootstrap_request({"action": "register", "address": my_address, "port": my_port})
         if response and response.get("status") == "registered":
             print("Successfully registered with the bootstrap server.")
     except Exception as e:
         print(f"Error registering with bootstrap server: {e}")
+    # Files shared before registration couldn't be announced yet
+    if shared_files or shared_collections:
+        announce_files(list(shared_files) + list(shared_collections))
+    if first_registration:
+        threading.Thread(target=heartbeat_loop, daemon=True).start()
+        threading.Thread(target=peer_directory_loop, daemon=True).start()
+        threading.Thread(target=pex_loop, daemon=True).start()
+
+def heartbeat_loop():
+    """
+    Refreshes this peer's TTL on the bootstrap server every HEARTBEAT_INTERVAL seconds.
+    If the server has forgotten us (expiry or restart), our files are announced again.
+    """
+    while True:
+        time.sleep(HEARTBEAT_INTERVAL)
+        try:
+            response = bootstrap_request({"action": "heartbeat", "address": local_peer["address"],
+                                          "port": local_peer["port"]})
+            if response and response.get("known") is False and (shared_files or shared_collections):
+                announce_files(list(shared_files) + list(shared_collections))
+        except Exception as e:
+            print(f"Error sending heartbeat to bootstrap server: {e}")
+
+class PeerDirectory:
+    """
+    Local table of known peers. One part caches the bootstrap server's peer list:
+    after one full list, refreshes ask get_peers_since for just the peers that
+    joined or left since the cached version, and a background thread refreshes it
+    while it is in use, so lookups are answered locally. The other part holds peers
+    learned by peer exchange, so peers can still be found when the bootstrap is slow
+    or down. After a failed refresh the bootstrap isn't asked again for a TTL.
+    """
+    def __init__(self, ttl=PEER_CACHE_TTL):
+        self.ttl = ttl
+        self.peers = {}          # Format: { (address, port): { "address": ip, "port": port } }
+        self.exchanged = OrderedDict()  # Format: { (address, port): (peer, time last heard of) }, oldest first
+        self.version = None      # Bootstrap version the cache reflects
+        self.epoch = None        # Bootstrap run that version belongs to
+        self.incremental = True  # Cleared if the bootstrap doesn't support get_peers_since
+        self.updated = None      # Monotonic time of the last refresh attempt
+        self.refreshed = None    # Monotonic time of the last successful refresh
+        self.used = False        # Read since the last background refresh
+        self.lock = threading.Lock()
+        self.refresh_lock = threading.Lock()
+
+    def get(self):
+        """
+        Returns the known peers, refreshing first if the cache is older than ttl.
+        """
+        self.used = True
+        if not self.fresh():
+            with self.refresh_lock:
+                # Callers that waited on someone else's refresh don't repeat it
+                if not self.fresh():
+                    self._refresh()
+        else:
+            directory_hits_counter.inc()
+        return self.known()
+
+    def known(self):
+        """
+        Returns every peer in the table without refreshing it.
+        """
+        with self.lock:
+            self._expire()
+            peers = list(self.peers.values())
+            peers.extend(peer for key, (peer, _) in self.exchanged.items() if key not in self.peers)
+            return peers
+
+    def fresh(self):
+        return self.updated is not None and time.monotonic() - self.updated < self.ttl
+
+    def refresh(self):
+        with self.refresh_lock:
+            self._refresh()
+
+    def _refresh(self):
+        self.updated = time.monotonic()
+        try:
+            if self.incremental:
+                self._fetch_changes()
+            else:
+                self._fetch_all()
+            self.refreshed = time.monotonic()
+            directory_refresh_counter.inc()
+        except Exception as e:
+            print(f"Error getting peer list: {e}")
+
+    def merge(self, peers, direct=False):
+        """
+        Adds peers learned by peer exchange. Peers already known keep their age unless
+        direct, i.e. this peer just talked to them, so dead peers age out of the table.
+        """
+        now = time.monotonic()
+        with self.lock:
+            for peer in peers:
+                if not isinstance(peer, dict):
+                    continue
+                address, port = peer.get("address"), peer.get("port")
+                if not isinstance(address, str) or not isinstance(port, int) or not 0 < port < 65536:
+                    continue
+                key = (address, port)
+                if local_peer is not None and key == (local_peer["address"], local_peer["port"]):
+                    continue
+                if key in self.exchanged and not direct:
+                    continue
+                self.exchanged[key] = ({"address": address, "port": port}, now)
+                self.exchanged.move_to_end(key)
+            while len(self.exchanged) > MAX_PEX_PEERS:
+                self.exchanged.popitem(last=False)
+
+    def forget(self, key):
+        """
+        Drops a peer learned through peer exchange that couldn't be reached.
+        Bootstrap peers stay: the delta sync only removes them when the bootstrap
+        server does, so dropping one here would lose it until the next reset.
+        """
+        with self.lock:
+            self.exchanged.pop(key, None)
+
+    def sample(self, limit):
+        """
+        Returns up to limit known peers chosen at random, for peer exchange.
+        Doesn't count as use, so gossip alone never keeps the bootstrap being asked.
+        """
+        peers = self.known()
+        return random.sample(peers, min(limit, len(peers)))
+
+    def _expire(self):
+        # Entries are ordered by when they were last heard of, so expired ones are at the front
+        deadline = time.monotonic() - PEX_PEER_TTL
+        while self.exchanged and next(iter(self.exchanged.values()))[1] < deadline:
+            self.exchanged.popitem(last=False)
+
+    def _fetch_changes(self):
+        reset = None  # Peers gathered so far while paging through a reset
+        while True:
+            request = {"action": "get_peers_since", "since": self.version, "epoch": self.epoch}
+            if reset is not None:
+                request.update(since=None, version=reset_version, offset=len(reset))
+            response = bootstrap_request(request)
+            if response is None or "version" not in response:
+                # Older bootstrap servers only have get_peers, and either refuse or ignore anything else
+                self.incremental = False
+                self._fetch_all()
+                return
+            if response.get("reset"):
+                # A reset comes in pages of one snapshot; start over if the server no longer holds ours
+                if reset is None or response.get("offset", 0) == 0:
+                    reset = {}
+                reset_version = response["version"]
+                reset.update(((peer["address"], peer["port"]), peer) for peer in response["peers"])
+                if response.get("more"):
+                    continue
+            with self.lock:
+                if reset is not None:
+                    self.peers = reset
+                    reset = None
+                else:
+                    for peer in response["removed"]:
+                        self.peers.pop((peer["address"], peer["port"]), None)
+                    for peer in response["added"]:
+                        self.peers[(peer["address"], peer["port"])] = peer
+                self.version = response["version"]
+                self.epoch = response["epoch"]
+            if not response.get("more"):
+                return
+
+    def _fetch_all(self):
+        response = bootstrap_request({"action": "get_peers"})
+        if not response or "peers" not in response:
+            raise ConnectionError("Bootstrap server sent no peer list")
+        with self.lock:
+            self.peers = {(peer["address"], peer["port"]): peer for peer in response["peers"]}
+
+    def snapshot(self):
+        """
+        Returns (peers from the bootstrap, peers from peer exchange, version,
+        seconds since the last successful refresh or None).
+        """
+        with self.lock:
+            self._expire()
+            age = time.monotonic() - self.refreshed if self.refreshed is not None else None
+            return len(self.peers), len(self.exchanged), self.version, age
+
+peer_directory = PeerDirectory()
+
+def peer_directory_loop():
+    """
+    Refreshes the peer directory in the background every half TTL while it is being
+    read, so callers seldom wait for the bootstrap server.
+    """
+    while True:
+        time.sleep(max(peer_directory.ttl / 2, 1))
+        if peer_directory.ttl and peer_directory.used:
+            peer_directory.used = False
+            peer_directory.refresh()
+
+def exchange_peers(peer):
+    """
+    Swaps samples of known peers with one peer over the pex action and merges its
+    sample into the peer directory. Returns False if the peer couldn't be reached.
+    """
+    key = (peer.get("address"), peer.get("port"))
+    conn = None
+    try:
+        conn = PeerConnection(key[0], key[1], timeout=5)
+        response = conn.request({"action": "pex", "address": local_peer["address"], "port": local_peer["port"],
+                                 "peers": peer_directory.sample(PEX_SAMPLE)})
+    except Exception as e:
+        print(f"Error exchanging peers with {key[0]}:{key[1]}: {e}")
+        peer_directory.forget(key)
+        return False
+    finally:
+        if conn is not None:
+            conn.close()
+    pex_counter.inc()
+    peer_directory.merge([peer], direct=True)
+    # Peers without pex answer with an error; they are still alive
+    peer_directory.merge(response.get("peers", [])[:PEX_SAMPLE])
+    return True
+
+def pex_loop():
+    """
+    Every PEX_INTERVAL seconds, exchanges peers with PEX_FANOUT peers picked at random
+    from the directory. The first round runs straight away so the table fills up
+    while the bootstrap is still reachable.
+    """
+    while True:
+        me = (local_peer["address"], local_peer["port"])
+        others = [peer for peer in peer_directory.known() if (peer.get("address"), peer.get("port")) != me]
+        if not others:
+            # Nobody to gossip with yet, so start from the bootstrap's list
+            others = [peer for peer in peer_directory.get() if (peer.get("address"), peer.get("port")) != me]
+        for peer in random.sample(others, min(PEX_FANOUT, len(others))):
+            exchange_peers(peer)
+        time.sleep(PEX_INTERVAL)
 
 def get_peer_list():
     """
-    Retrieves the list of active peers from the bootstrap server.
+    Returns the active peers, from the peer directory cache when it is fresh.
+    """
+    return peer_directory.get()
+
+def announce_files(filenames):
+    """
+    Tells the bootstrap server that this peer shares filenames, so downloaders can
+    find it with who_has. Sent ANNOUNCE_BATCH files per request. Does nothing until
+    the peer has registered.
     """
+    if local_peer is None:
+        return
+    files = []
+    for name in filenames:
+        if name in shared_files:
+            manifest = shared_files[name]
+        elif name in shared_collections:
+            manifest = shared_collections[name]
+        else:
+            manifest = active_downloads[name]["state"].manifest
+        files.append({"filename": name, "merkle_root": manifest["merkle_root"]})
     try:
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(BOOTSTRAP_SERVER)
-        message = {"action": "get_peers"}
-        send_json(s, message)
-        response = recv_json(s)
-        s.close()
+        for start in range(0, len(files), ANNOUNCE_BATCH):
+            batch = files[start:start + ANNOUNCE_BATCH]
+            response = bootstrap_request({"action": "announce", "address": local_peer["address"],
+                                          "port": local_peer["port"], "files": batch})
+            if not response or response.get("status") != "announced":
+                print(f"Bootstrap server did not acknowledge the announcement of {len(batch)} file(s): {response}")
+                return
+    except Exception as e:
+        print(f"Error announcing files to bootstrap server: {e}")
+
+def unannounce_files(filenames):
+    """
+    Withdraws filenames from the bootstrap server's index, e.g. a download that
+    was announced while in progress but didn't finish.
+    """
+    if local_peer is None:
+        return
+    try:
+        bootstrap_request({"action": "unannounce", "address": local_peer["address"],
+                           "port": local_peer["port"], "filenames": filenames})
+    except Exception as e:
+        print(f"Error withdrawing files from bootstrap server: {e}")
+
+def who_has(filename):
+    """
+    Asks the bootstrap server which peers announced filename.
+    Returns an empty list if none did or the server doesn't support lookups.
+    """
+    try:
+        response = bootstrap_request({"action": "who_has", "filename": filename})
         if response and "peers" in response:
             return response["peers"]
     except Exception as e:
-        print(f"Error getting peer list: {e}")
+        print(f"Error looking up '{filename}' on bootstrap server: {e}")
     return []
 
 def handle_client_connection(conn, addr):
     """
     Handles incoming requests from other peers.
+    The connection stays open so a client can pipeline many requests on it;
+    peers that send a single request and close are served exactly as before.
+    A connection idle for IDLE_TIMEOUT seconds is closed.
     """
+    connections_gauge.inc()
     try:
-        file_obj = conn.makefile(mode='rw')
-        line = file_obj.readline()
-        if not line:
-            return
-        message = json.loads(line.strip())
-        action = message.get("action")
-        if action == "file_request":
-            filename = message.get("filename")
-            if filename in shared_files:
-                # Prepare file metadata by re-splitting the file
-                file_path = os.path.join("files", filename)
-                _, chunk_hashes = split_file(file_path, CHUNK_SIZE)
-                response = {
-                    "action": "file_info",
-                    "filename": filename,
-                    "chunk_size": CHUNK_SIZE,
-                    "num_chunks": len(chunk_hashes),
-                    "chunk_hashes": chunk_hashes
-                }
-                file_obj.write(json.dumps(response) + "\n")
-                file_obj.flush()
-            else:
-                response = {"action": "error", "message": "File not found"}
-                file_obj.write(json.dumps(response) + "\n")
-                file_obj.flush()
-        elif action == "get_chunk":
-            filename = message.get("filename")
-            chunk_index = message.get("chunk_index")
-            file_path = os.path.join("files", filename)
-            if os.path.exists(file_path):
-                with open(file_path, "rb") as f:
-                    f.seek(chunk_index * CHUNK_SIZE)
-                    chunk_data = f.read(CHUNK_SIZE)
-                    # Encode the chunk so it can be sent in JSON
-                    encoded_data = encode_chunk(chunk_data)
-                    response = {
-                        "action": "chunk_data",
-                        "filename": filename,
-                        "chunk_index": chunk_index,
-                        "data": encoded_data
-                    }
-                    file_obj.write(json.dumps(response) + "\n")
-                    file_obj.flush()
-            else:
-                response = {"action": "error", "message": "File not found"}
-                file_obj.write(json.dumps(response) + "\n")
-                file_obj.flush()
+        conn.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        reader = MessageReader(conn)
+        while True:
+            conn.settimeout(IDLE_TIMEOUT)
+            try:
+                message = reader.read_message()
+            except socket.timeout:
+                return
+            if message is None:
+                return
+            # A peer that stops reading mid-reply times out rather than holding its upload slot
+            conn.settimeout(SEND_TIMEOUT)
+            handle_request(conn, message, addr[0])
     except Exception as e:
         print(f"Error handling client connection from {addr}: {e}")
     finally:
+        connections_gauge.dec()
         conn.close()
 
-def server_listener(my_port):
+def build_reply(message):
+    """
+    Builds the JSON reply to a request. Binary get_chunk requests are served
+    separately so their payload never goes through JSON.
+    """
+    action = message.get("action")
+    if action == "file_request":
+        filename = message.get("filename")
+        if filename in shared_collections:
+            return collection_info(filename)
+        # Served from the manifest cache; the file is only re-hashed if it changed on disk
+        manifest = manifest_cache.get(os.path.join("files", filename)) if filename in shared_files else None
+        if manifest is None and filename in active_downloads and message.get("merkle"):
+            return partial_file_info(filename)
+        if manifest is None:
+            return {"action": "error", "message": "File not found"}
+        shared_files[filename] = manifest
+        response = {
+            "action": "file_info",
+            "filename": filename,
+            "chunk_size": manifest["chunk_size"],
+            "file_size": manifest["file_size"],
+            "num_chunks": manifest["num_chunks"],
+            "merkle_root": manifest["merkle_root"],
+            # Advertise binary chunk frames and pipelining; older peers simply ignore these fields
+            "binary": True,
+            "persistent": True,
+            "codecs": list(CODECS)
+        }
+        if message.get("merkle"):
+            # Hashes are fetched later in ranges with get_hashes, keeping this reply small
+            response["merkle"] = True
+        else:
+            response["chunk_hashes"] = manifest["chunk_hashes"]
+        return response
+    elif action == "get_hashes":
+        filename = message.get("filename")
+        file_path = os.path.join("files", filename)
+        manifest = manifest_cache.get(file_path) if filename in shared_files else None
+        if manifest is None:
+            return {"action": "error", "message": "File not found"}
+        start = max(0, message.get("start", 0))
+        end = min(message.get("end", start + MAX_HASH_RANGE), start + MAX_HASH_RANGE, manifest["num_chunks"])
+        if start >= end:
+            return {"action": "error", "message": "Invalid hash range"}
+        return {
+            "action": "hashes",
+            "filename": filename,
+            "start": start,
+            "chunk_hashes": manifest["chunk_hashes"][start:end],
+            "proof": merkle_range_proof(manifest_cache.merkle_levels(file_path, manifest), start, end)
+        }
+    elif action == "stats":
+        return {"action": "stats", "metrics": REGISTRY.snapshot()}
+    elif action == "pex":
+        # The sender just reached us, so it is alive; reply with a sample of our own
+        reply = {"action": "pex", "peers": peer_directory.sample(PEX_SAMPLE)}
+        peer_directory.merge([{"address": message.get("address"), "port": message.get("port")}], direct=True)
+        peer_directory.merge(message.get("peers", [])[:PEX_SAMPLE])
+        return reply
+    elif action == "get_chunk":
+        chunk_index = message.get("chunk_index")
+        flags, chunk_data, error = read_chunk(message.get("filename"), chunk_index, requested_codec(message))
+        if error:
+            return {"action": "error", "message": error}
+        # Encode the chunk so it can be sent in JSON
+        response = {
+            "action": "chunk_data",
+            "filename": message.get("filename"),
+            "chunk_index": chunk_index,
+            "data": encode_chunk(chunk_data)
+        }
+        if flags:
+            response["codec"] = message.get("codec")
+        return response
+    return {"action": "error", "message": f"Unknown action: {action}"}
+
+def requested_codec(message):
+    """
+    Returns the codec a get_chunk request asked for, or None if none or unsupported.
+    """
+    codec = message.get("codec")
+    return codec if codec in CODECS else None
+
+def partial_file_info(filename):
     """
-    Runs a server that listens for incoming connections from other peers.
+    file_info for a file this peer is still downloading: the Merkle manifest plus
+    a bitmap of the chunks it can already serve. Hashes must come from full seeders.
+    """
+    state = active_downloads[filename]["state"]
+    manifest = state.manifest
+    with state.lock:
+        have = state.bitmap.encode()
+    return {
+        "action": "file_info",
+        "filename": filename,
+        "chunk_size": manifest["chunk_size"],
+        "file_size": manifest["file_size"],
+        "num_chunks": manifest["num_chunks"],
+        "merkle_root": manifest["merkle_root"],
+        "have": have,
+        "binary": True,
+        "persistent": True,
+        "codecs": list(CODECS),
+        "merkle": True
+    }
+
+def collection_info(name):
+    """
+    The single manifest of a shared collection: every file's path, size, chunk size
+    and chunk hashes. Its chunks are served with get_batch.
+    """
+    collection = shared_collections[name]
+    return {
+        "action": "collection_info",
+        "filename": name,
+        "merkle_root": collection["merkle_root"],
+        "num_files": len(collection["files"]),
+        "file_size": sum(entry["file_size"] for entry in collection["files"]),
+        "files": collection["files"],
+        "binary": True,
+        "persistent": True,
+        "codecs": list(CODECS)
+    }
+
+def batch_member(collection, item):
+    """
+    Returns (filename, chunk_index) for a get_batch item [path, chunk_index], or
+    (None, None) if it doesn't name a chunk of a shared collection file.
+    """
+    try:
+        path, chunk_index = item
+    except (TypeError, ValueError):
+        return None, None
+    filename = f"{collection}/{path}"
+    if filename not in collection_members or not isinstance(chunk_index, int):
+        return None, None
+    return filename, chunk_index
+
+def locate_chunk(filename, chunk_index):
+    """
+    Finds a chunk on disk. Returns (file object, stamp, offset, length, error);
+    error is a message string if the file or chunk doesn't exist. Only shared files,
+    collection members and in-progress downloads are served, so a request can never
+    reach other paths under files/ or outside it.
+    """
+    if not isinstance(filename, str):
+        return None, None, 0, 0, "File not found"
+    download = active_downloads.get(filename)
+    if download is not None:
+        # Serve verified chunks of an in-progress download from its .part file
+        if not 0 <= chunk_index < download["state"].bitmap.num_chunks or chunk_index not in download["state"].bitmap:
+            return None, None, 0, 0, "Chunk not available"
+        f, file_size, stamp = file_handles.get(download["temp_path"])
+    elif filename in shared_files or filename in collection_members:
+        f, file_size, stamp = file_handles.get(os.path.join("files", filename))
+    else:
+        return None, None, 0, 0, "File not found"
+    if f is None:
+        return None, None, 0, 0, "File not found"
+    # Offsets follow the file's own manifest, so they agree with the file_info it was sent
+    if download is not None:
+        chunk_size = download["state"].manifest["chunk_size"]
+    else:
+        manifest = shared_files.get(filename) or collection_members.get(filename)
+        chunk_size = manifest["chunk_size"] if manifest else CHUNK_SIZE
+    offset = chunk_index * chunk_size
+    length = min(chunk_size, file_size - offset)
+    if offset < 0 or length <= 0:
+        return None, None, 0, 0, "Invalid chunk index"
+    return f, stamp, offset, length, None
+
+def chunk_payload(f, stamp, offset, length, codec=None):
+    """
+    Returns (flags, payload) for a located chunk: from the chunk cache, or compressed
+    with codec when that makes it smaller. flags is the codec's CODECS value, or 0
+    for the raw chunk. payload is None when the raw chunk isn't cached, so the
+    caller can send it straight from the file.
+    """
+    payload, admit = chunk_cache.get(stamp, offset, codec)
+    if payload is None and (admit or codec):
+        payload = read_at(f.fileno(), offset, length)
+        if codec:
+            payload = compress_chunk(payload, codec) or payload
+        if admit:
+            chunk_cache.put(stamp, offset, payload, codec)
+    # Only chunks that shrank are sent compressed
+    flags = CODECS[codec] if codec and payload is not None and len(payload) < length else 0
+    return flags, payload
+
+def read_chunk(filename, chunk_index, codec=None):
+    """
+    Reads a chunk from disk or the cache. Returns (flags, chunk_data, error);
+    flags names the codec chunk_data is compressed with, or is 0.
+    """
+    f, stamp, offset, length, error = locate_chunk(filename, chunk_index)
+    if error:
+        return 0, None, error
+    flags, data = chunk_payload(f, stamp, offset, length, codec)
+    if data is None:
+        data = read_at(f.fileno(), offset, length)
+    return flags, data, None
+
+def handle_request(conn, message, peer):
+    """
+    Answers a single request read from a peer connection. Chunks are only sent
+    while holding an upload slot, paced by the upload limits. A get_batch is
+    answered with one frame per requested chunk, in order, tagged with its
+    position in the batch.
+    """
+    action = message.get("action")
+    if action == "get_batch":
+        codec = requested_codec(message)
+        for position, item in enumerate(message.get("chunks", [])):
+            filename, chunk_index = batch_member(message.get("collection"), item)
+            send_chunk(conn, peer, position, filename, chunk_index, codec)
+        return
+    if action != "get_chunk":
+        send_json(conn, build_reply(message))
+        return
+    if message.get("binary", False):
+        chunk_index = message.get("chunk_index")
+        send_chunk(conn, peer, chunk_index, message.get("filename"), chunk_index, requested_codec(message))
+        return
+    uploads.wait(peer)
+    sent = 0
+    try:
+        response = build_reply(message)
+        sent = len(response.get("data", ""))
+        time.sleep(uploads.throttle(peer, sent))
+        send_json(conn, response)
+    finally:
+        if sent:
+            served_counter.inc()
+            bytes_out_counter.inc(sent)
+        uploads.release(peer, sent)
+
+def send_chunk(conn, peer, frame_index, filename, chunk_index, codec):
+    """
+    Sends a chunk as a binary frame tagged frame_index, or an error frame if
+    filename is None or the chunk can't be found.
+    """
+    uploads.wait(peer)
+    sent = 0
+    try:
+        if filename is None:
+            f, error = None, "File not found"
+        else:
+            f, stamp, offset, length, error = locate_chunk(filename, chunk_index)
+        if error:
+            send_frame(conn, FRAME_ERROR, frame_index, error.encode())
+            return
+        flags, data = chunk_payload(f, stamp, offset, length, codec)
+        sent = length if data is None else len(data)
+        time.sleep(uploads.throttle(peer, sent))
+        if data is not None:
+            send_frame(conn, FRAME_CHUNK, frame_index, data, flags)
+        else:
+            # Header, then the payload straight from the page cache with no Base64 or JSON
+            conn.sendall(pack_frame_header(FRAME_CHUNK, frame_index, length), MSG_MORE)
+            send_file_range(conn, f.fileno(), offset, length)
+    finally:
+        if sent:
+            served_counter.inc()
+            bytes_out_counter.inc(sent)
+        uploads.release(peer, sent)
+
+def server_listener(my_port, max_connections=MAX_CONNECTIONS, backlog=SERVER_BACKLOG):
+    """
+    Runs a server that listens for incoming connections from other peers,
+    with a thread per connection. Once max_connections are open, new
+    connections wait in the listen backlog.
     """
     server = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
     server.bind(("0.0.0.0", my_port))
-    server.listen(5)
+    server.listen(backlog)
+    slots = threading.BoundedSemaphore(max_connections)
     print(f"Peer listening on port {my_port}")
+
+    def serve(conn, addr):
+        try:
+            handle_client_connection(conn, addr)
+        finally:
+            slots.release()
+
     try:
         while True:
-            conn, addr = server.accept()
-            threading.Thread(target=handle_client_connection, args=(conn, addr), daemon=True).start()
+            slots.acquire()
+            try:
+                conn, addr = server.accept()
+            except OSError as e:
+                # e.g. out of file descriptors; keep listening once some are freed
+                slots.release()
+                print(f"Error accepting connection: {e}")
+                time.sleep(0.1)
+                continue
+            threading.Thread(target=serve, args=(conn, addr), daemon=True).start()
     except Exception as e:
         print(f"Server listener error: {e}")
     finally:
         server.close()
 
+async def handle_async_connection(reader, writer):
+    """
+    Event-loop counterpart of handle_client_connection. Disk reads and manifest
+    work run on the loop's executor so a slow disk never stalls other connections.
+    Idle connections are closed after IDLE_TIMEOUT seconds as well.
+    """
+    loop = asyncio.get_running_loop()
+    addr = writer.get_extra_info("peername")
+    peer = addr[0]
+
+    async def drain():
+        # A peer that stops reading times out rather than holding its upload slot
+        try:
+            await asyncio.wait_for(writer.drain(), SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            raise TimeoutError("timed out") from None
+
+    async def acquire_slot():
+        # Same upload slots and limits as the threaded server, waited for without blocking the loop
+        granted = loop.create_future()
+        uploads.acquire(peer, lambda: loop.call_soon_threadsafe(granted.set_result, None))
+        await granted
+
+    async def send_chunk(frame_index, filename, chunk_index, codec):
+        await acquire_slot()
+        sent = 0
+        try:
+            if filename is None:
+                error = "File not found"
+            else:
+                flags, chunk_data, error = await loop.run_in_executor(None, read_chunk, filename, chunk_index, codec)
+            if error:
+                payload = error.encode()
+                writer.write(pack_frame_header(FRAME_ERROR, frame_index, len(payload)) + payload)
+            else:
+                await asyncio.sleep(uploads.throttle(peer, len(chunk_data)))
+                writer.write(pack_frame_header(FRAME_CHUNK, frame_index, len(chunk_data), flags))
+                writer.write(chunk_data)
+                sent = len(chunk_data)
+            await drain()
+        finally:
+            if sent:
+                served_counter.inc()
+                bytes_out_counter.inc(sent)
+            uploads.release(peer, sent)
+
+    connections_gauge.inc()
+    try:
+        while True:
+            try:
+                line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+            except asyncio.TimeoutError:
+                return
+            if not line:
+                return
+            message = json.loads(line)
+            action = message.get("action")
+            if action == "get_batch":
+                codec = requested_codec(message)
+                for position, item in enumerate(message.get("chunks", [])):
+                    filename, chunk_index = batch_member(message.get("collection"), item)
+                    await send_chunk(position, filename, chunk_index, codec)
+                continue
+            if action != "get_chunk":
+                response = await loop.run_in_executor(None, build_reply, message)
+                writer.write((json.dumps(response) + "\n").encode())
+                await drain()
+                continue
+            if message.get("binary", False):
+                chunk_index = message.get("chunk_index")
+                await send_chunk(chunk_index, message.get("filename"), chunk_index, requested_codec(message))
+                continue
+            await acquire_slot()
+            sent = 0
+            try:
+                response = await loop.run_in_executor(None, build_reply, message)
+                sent = len(response.get("data", ""))
+                await asyncio.sleep(uploads.throttle(peer, sent))
+                writer.write((json.dumps(response) + "\n").encode())
+                await drain()
+            finally:
+                if sent:
+                    served_counter.inc()
+                    bytes_out_counter.inc(sent)
+                uploads.release(peer, sent)
+    except Exception as e:
+        print(f"Error handling client connection from {addr}: {e}")
+    finally:
+        connections_gauge.dec()
+        writer.close()
+
+async def serve_async(my_port, max_connections, backlog):
+    loop = asyncio.get_running_loop()
+    loop.set_default_executor(ThreadPoolExecutor(max_workers=ASYNC_IO_THREADS))
+    slots = asyncio.Semaphore(max_connections)
+
+    async def on_connect(reader, writer):
+        # Connections beyond the limit wait here, costing only their socket
+        async with slots:
+            await handle_async_connection(reader, writer)
+
+    # Lines may be as long as the threaded server accepts, e.g. a get_batch with long paths
+    server = await asyncio.start_server(on_connect, "0.0.0.0", my_port, backlog=backlog, limit=MAX_MESSAGE_SIZE)
+    print(f"Peer listening on port {my_port} (asyncio)")
+    async with server:
+        await server.serve_forever()
+
+def async_server_listener(my_port, max_connections=MAX_CONNECTIONS, backlog=SERVER_BACKLOG):
+    """
+    Runs the peer server on an asyncio event loop instead of a thread per connection.
+    """
+    try:
+        asyncio.run(serve_async(my_port, max_connections, backlog))
+    except Exception as e:
+        print(f"Server listener error: {e}")
+
 def share_file(filename):
     """
     Shares a file by adding it to the local shared_files index.
     Ensure the file is placed in the 'files' directory.
+    A directory there is shared as a collection.
     """
     file_path = os.path.join("files", filename)
-    if not os.path.exists(file_path):
+    if os.path.isdir(file_path):
+        share_collection(filename)
+        return
+    manifest = manifest_cache.get(file_path, share_chunk_size)
+    if manifest is None:
         print(f"File {filename} not found in the files/ directory.")
         return
-    _, chunk_hashes = split_file(file_path, CHUNK_SIZE)
-    shared_files[filename] = {
-        "num_chunks": len(chunk_hashes),
-        "chunk_hashes": chunk_hashes
-    }
+    shared_files[filename] = manifest
+    announce_files([filename])
     print(f"File '{filename}' is now shared with peers.")
 
-def download_file(filename):
+def share_collection(name):
     """
-    Downloads a file from available peers chunk by chunk.
+    Shares every file under files/<name> as one collection, described by a single
+    manifest. Files are hashed only if they changed since they were last indexed.
     """
-    peers = get_peer_list()
-    if not peers:
-        print("No peers available.")
-        return
+    name = name.rstrip("/")
+    dir_path = os.path.join("files", name)
+    files = []
+    members = {}
+    started = time.perf_counter()
+    for root, dirs, names in os.walk(dir_path):
+        dirs.sort()
+        for file_name in sorted(names):
+            if file_name.endswith((".part", ".state")):
+                continue
+            file_path = os.path.join(root, file_name)
+            manifest = manifest_cache.get(file_path, share_chunk_size, batch=True)
+            if manifest is None:
+                continue
+            path = os.path.relpath(file_path, dir_path).replace(os.sep, "/")
+            files.append({"path": path, "file_size": manifest["file_size"], "chunk_size": manifest["chunk_size"],
+                          "chunk_hashes": manifest["chunk_hashes"]})
+            members[f"{name}/{path}"] = manifest
+    manifest_cache.save()
+    elapsed = time.perf_counter() - started
+    total = sum(entry["file_size"] for entry in files)
+    print(f"Indexed collection '{name}': {len(files)} files, {total / (1024 * 1024):.1f} MB in {elapsed:.2f}s.")
+    for member in [member for member in collection_members if member.startswith(name + "/")]:
+        del collection_members[member]
+    collection_members.update(members)
+    shared_collections[name] = {"merkle_root": collection_root(files), "files": files}
+    announce_files([name])
+    print(f"Collection '{name}' is now shared with peers.")
+
+def fetch_chunk(peer_addr, peer_port, filename, chunk_index, binary=False):
+    """
+    Requests a single chunk from a peer and returns its raw bytes, or None on error.
+    Uses binary frames when the peer advertised them, JSON with Base64 otherwise.
+    """
+    s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    try:
+        s.connect((peer_addr, peer_port))
+        chunk_request = {"action": "get_chunk", "filename": filename, "chunk_index": chunk_index}
+        if binary:
+            chunk_request["binary"] = True
+            send_json(s, chunk_request)
+            frame_type, _, _, payload = MessageReader(s).read_frame()
+            if frame_type == FRAME_CHUNK:
+                bytes_in_counter.inc(len(payload))
+                return payload
+            print(f"Peer {peer_addr}:{peer_port} error for chunk {chunk_index}: {payload.decode(errors='replace')}")
+            return None
+        send_json(s, chunk_request)
+        chunk_response = recv_json(s)
+        if chunk_response and chunk_response.get("action") == "chunk_data":
+            bytes_in_counter.inc(len(chunk_response.get("data")))
+            return decode_chunk(chunk_response.get("data"))
+        return None
+    finally:
+        s.close()
+
+class PeerConnection:
+    """
+    A long-lived connection to one peer that can keep several requests in flight.
+    """
+    def __init__(self, address, port, timeout=10):
+        self.address = address
+        self.port = port
+        self.sock = socket.create_connection((address, port), timeout=timeout)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.reader = MessageReader(self.sock)
+
+    def request(self, message):
+        """
+        Sends a JSON request and returns the JSON reply.
+        """
+        send_json(self.sock, message)
+        response = self.reader.read_message()
+        if response is None:
+            raise ConnectionError("Peer closed the connection")
+        return response
+
+    def fetch_chunks(self, filename, indices, window=PIPELINE_WINDOW, stats=None, codec=None, chunk_size=CHUNK_SIZE):
+        """
+        Generator that pipelines get_chunk requests, keeping up to window of them outstanding.
+        With stats, the window follows the peer's estimated bandwidth-delay product and
+        every reply is recorded. Yields (chunk_index, chunk_data); chunk_data is None
+        if the peer refused the chunk. Replies are matched by the chunk index in the
+        frame header, so order doesn't matter. With codec, the peer may compress
+        chunks; they are decompressed here, capped at chunk_size.
+        """
+        pending = iter(indices)
+        in_flight = {}  # Format: { chunk_index: time sent }
+        exhausted = False
+
+        def fill():
+            nonlocal exhausted
+            limit = stats.window() if stats is not None else window
+            while not exhausted and len(in_flight) < limit:
+                chunk_index = next(pending, None)
+                if chunk_index is None:
+                    exhausted = True
+                    return
+                request = {"action": "get_chunk", "filename": filename, "chunk_index": chunk_index, "binary": True}
+                if codec:
+                    request["codec"] = codec
+                send_json(self.sock, request)
+                in_flight[chunk_index] = time.monotonic()
+
+        fill()
+        while in_flight:
+            frame_type, flags, chunk_index, payload = self.reader.read_frame()
+            sent_at = in_flight.pop(chunk_index, None)
+            if sent_at is None:
+                raise ConnectionError(f"Unexpected chunk {chunk_index} from {self.address}:{self.port}")
+            if frame_type != FRAME_CHUNK:
+                fill()
+                yield chunk_index, None
+                continue
+            wire_bytes = len(payload)
+            bytes_in_counter.inc(wire_bytes)
+            payload = decompress_chunk(payload, flags, chunk_size)
+            if stats is not None:
+                # Throughput counts chunk content, so the window stays in step with chunks delivered
+                stats.record(len(payload), time.monotonic() - sent_at, wire_bytes)
+            fill()
+            yield chunk_index, payload
+
+    def fetch_batches(self, collection, batches, window=BATCH_WINDOW, codec=None):
+        """
+        Generator that pipelines get_batch requests for chunks of a collection's files,
+        keeping up to window batches outstanding. Each batch is a list of items
+        starting (path, chunk_index, length, ...); the peer answers with one frame
+        per item, in order. Yields (batch, payloads) with a payload per item, None
+        where the peer refused the chunk.
+        """
+        pending = iter(batches)
+        in_flight = deque()
+
+        def fill():
+            while len(in_flight) < window:
+                batch = next(pending, None)
+                if batch is None:
+                    return
+                request = {"action": "get_batch", "collection": collection, "binary": True,
+                           "chunks": [[item[0], item[1]] for item in batch]}
+                if codec:
+                    request["codec"] = codec
+                send_json(self.sock, request)
+                in_flight.append(batch)
 
-    # Try each peer until the file is found
-    for peer in peers:
+        fill()
+        while in_flight:
+            batch = in_flight.popleft()
+            payloads = []
+            for position, item in enumerate(batch):
+                frame_type, flags, frame_index, payload = self.reader.read_frame()
+                if frame_index != position:
+                    raise ConnectionError(f"Unexpected batch frame {frame_index} from {self.address}:{self.port}")
+                if frame_type != FRAME_CHUNK:
+                    payloads.append(None)
+                    continue
+                bytes_in_counter.inc(len(payload))
+                payloads.append(decompress_chunk(payload, flags, item[2]))
+            fill()
+            yield batch, payloads
+
+    def close(self):
+        self.sock.close()
+
+class PeerStats:
+    """
+    Running estimates of one peer's round-trip time and throughput. They size how
+    many requests are kept outstanding to the peer, so fast or distant peers get
+    deeper pipelines.
+    """
+    def __init__(self, chunk_size, latency=None):
+        self.chunk_size = chunk_size
+        self.latency = latency  # Histogram every reply's latency is also recorded in
+        self.rtt = None         # EWMA of seconds from request to reply
+        self.min_rtt = None     # Lowest latency seen, i.e. without queueing behind other requests
+        self.throughput = None  # EWMA of bytes per second
+        self.bytes_received = 0
+        self.wire_bytes = 0     # Bytes actually transferred, less than bytes_received when compressed
+        self.last_reply = None
+        self.lock = threading.Lock()
+
+    def record(self, nbytes, latency, wire_bytes=None):
+        now = time.monotonic()
+        if self.latency is not None:
+            self.latency.observe(latency)
+        with self.lock:
+            self.bytes_received += nbytes
+            self.wire_bytes += nbytes if wire_bytes is None else wire_bytes
+            self.rtt = latency if self.rtt is None else 0.8 * self.rtt + 0.2 * latency
+            self.min_rtt = latency if self.min_rtt is None else min(self.min_rtt, latency)
+            if self.last_reply is not None:
+                interval = now - self.last_reply
+                # Gaps much longer than a round trip mean the pipeline was idle, not slow
+                if 0 < interval <= 4 * self.rtt:
+                    sample = nbytes / interval
+                    self.throughput = sample if self.throughput is None else 0.8 * self.throughput + 0.2 * sample
+            self.last_reply = now
+
+    def window(self):
+        """
+        Returns how many requests to keep outstanding: twice the bandwidth-delay product.
+        """
+        with self.lock:
+            if self.throughput is None or self.min_rtt is None:
+                return PIPELINE_WINDOW
+            bdp = self.throughput * self.min_rtt / self.chunk_size
+        return max(MIN_PIPELINE_WINDOW, min(MAX_PIPELINE_WINDOW, int(2 * bdp) + 2))
+
+    def describe(self):
+        with self.lock:
+            if self.throughput is None:
+                return "no estimate yet"
+            summary = f"{self.throughput / (1024 * 1024):.1f} MB/s, rtt {self.rtt * 1000:.1f} ms"
+            if self.wire_bytes < self.bytes_received:
+                summary += f", {self.wire_bytes / (1024 * 1024):.1f} MB on the wire"
+            return summary
+
+class ChunkScheduler:
+    """
+    Decides which chunk each peer requests next during a swarm download.
+
+    - Rarest first: chunks are ordered by how many peers hold them, so chunks only
+      a few partial peers have are fetched before those peers go away. With only
+      full seeders this is plain file order.
+    - Each peer walks that order with its own cursor, skipping chunks it lacks or
+      that are already claimed. Retried chunks are offered before the cursor.
+    - Endgame: once a chunk has been delivered, nothing is left unclaimed and at
+      most ENDGAME_CHUNKS are still outstanding, idle peers duplicate those requests,
+      up to ENDGAME_COPIES peers per chunk. The first verified copy wins.
+    - A chunk a peer refused is never offered to that peer again, and refusals
+      count towards MAX_CHUNK_ATTEMPTS like failed verifications.
+    - Workers join and leave per peer; once no live worker's peer can serve any chunk
+      still needed, the download is aborted instead of waiting forever.
+    """
+    def __init__(self, num_chunks, indices, haves):
+        self.cond = threading.Condition()
+        self.needed = set(indices)        # Not yet verified
+        self.pending = set(self.needed)   # Needed and not requested from anyone
+        self.retry = deque()              # Pending chunks that were handed back
+        self.in_flight = {}               # Format: { chunk_index: [peer_key of each outstanding request] }
+        self.delivered = 0                # Chunks verified so far
+        self.attempts = [0] * num_chunks
+        self.refused = {}                 # Format: { chunk_index: {peer_key that refused it} }
+        self.aborted = False
+        self.haves = haves                # Format: { peer_key: ChunkBitmap, or None for a full seeder }
+        self.live = {}                    # Format: { peer_key: workers still running }
+        # Full seeders hold every chunk, so only partial peers need counting per chunk
+        availability = [sum(1 for have in haves.values() if have is None)] * num_chunks
+        for have in haves.values():
+            if have is not None:
+                for i in self.needed:
+                    if i in have:
+                        availability[i] += 1
+        self.order = sorted(self.needed, key=lambda i: (availability[i], i))
+        self.cursors = dict.fromkeys(haves, 0)
+        missing = [i for i in self.needed if availability[i] == 0]
+        if missing:
+            print(f"Warning: {len(missing)} chunks are not held by any known peer.")
+
+    @property
+    def remaining(self):
+        return len(self.needed)
+
+    @property
+    def finished(self):
+        return not self.needed or self.aborted
+
+    def _take(self, chunk_index, peer_key):
+        self.pending.discard(chunk_index)
+        self.in_flight.setdefault(chunk_index, []).append(peer_key)
+        return chunk_index
+
+    def _serves(self, peer_key, chunk_index):
+        # Whether peer_key claims to hold the chunk and hasn't refused it
+        have = self.haves.get(peer_key)
+        return ((have is None or chunk_index in have) and
+                peer_key not in self.refused.get(chunk_index, ()))
+
+    def _next_for(self, peer_key, exclude):
+        for _ in range(len(self.retry)):
+            chunk_index = self.retry.popleft()
+            if chunk_index not in self.pending:
+                continue
+            if self._serves(peer_key, chunk_index):
+                return self._take(chunk_index, peer_key)
+            self.retry.append(chunk_index)
+        cursor = self.cursors.get(peer_key, 0)
+        while cursor < len(self.order):
+            chunk_index = self.order[cursor]
+            cursor += 1
+            if chunk_index in self.pending and self._serves(peer_key, chunk_index):
+                self.cursors[peer_key] = cursor
+                return self._take(chunk_index, peer_key)
+        self.cursors[peer_key] = cursor
+        if self.delivered and not self.pending and len(self.in_flight) <= ENDGAME_CHUNKS:
+            # Duplicate whichever outstanding chunk has the fewest copies requested, on another peer
+            candidates = [i for i, requesters in self.in_flight.items()
+                          if i not in exclude and peer_key not in requesters and len(requesters) < ENDGAME_COPIES
+                          and self._serves(peer_key, i)]
+            if candidates:
+                return self._take(min(candidates, key=lambda i: len(self.in_flight[i])), peer_key)
+        return None
+
+    def claim(self, peer_key, exclude=(), wait=False):
+        """
+        Returns the next chunk index peer_key should request, or None if there is
+        nothing for it right now. With wait=True, blocks until there is a chunk
+        and only returns None once the download is finished or aborted.
+        """
+        with self.cond:
+            while not self.finished:
+                chunk_index = self._next_for(peer_key, exclude)
+                if chunk_index is not None or not wait:
+                    return chunk_index
+                if self._stranded():
+                    self._abort_stranded()
+                    break
+                self.cond.wait()
+            return None
+
+    def join(self, peer_key):
+        """
+        Records a worker for peer_key. Called before the worker starts.
+        """
+        with self.cond:
+            self.live[peer_key] = self.live.get(peer_key, 0) + 1
+
+    def leave(self, peer_key):
+        """
+        Records that a worker for peer_key stopped, aborting if what is still
+        needed is now out of reach of every remaining worker.
+        """
+        with self.cond:
+            self.live[peer_key] -= 1
+            if not self.live[peer_key]:
+                del self.live[peer_key]
+            if not self.finished and self._stranded():
+                self._abort_stranded()
+            self.cond.notify_all()
+
+    def _stranded(self):
+        # Outstanding chunks come back through complete, reject or release, which wake the waiters
+        if self.in_flight or not self.pending:
+            return False
+        for peer_key in self.live:
+            if any(self._serves(peer_key, i) for i in self.pending):
+                return False
+        return True
+
+    def _abort_stranded(self):
+        print(f"No remaining peer can serve the {len(self.pending)} missing chunks. Aborting download.")
+        self.aborted = True
+        self.cond.notify_all()
+
+    def _settle(self, chunk_index, peer_key):
+        requesters = self.in_flight.get(chunk_index)
+        if requesters is None:
+            return
+        if peer_key in requesters:
+            requesters.remove(peer_key)
+        if not requesters:
+            del self.in_flight[chunk_index]
+
+    def _requeue(self, chunk_index):
+        if chunk_index in self.needed and chunk_index not in self.in_flight and chunk_index not in self.pending:
+            self.pending.add(chunk_index)
+            self.retry.append(chunk_index)
+
+    def complete(self, chunk_index, peer_key):
+        """
+        Records a verified chunk. Returns False if another peer delivered it first.
+        """
+        with self.cond:
+            self._settle(chunk_index, peer_key)
+            if chunk_index not in self.needed:
+                return False
+            self.delivered += 1
+            self.needed.discard(chunk_index)
+            self.pending.discard(chunk_index)
+            self.cond.notify_all()
+            return True
+
+    def reject(self, chunk_index, peer_key):
+        """
+        Puts back a chunk that failed verification, aborting after MAX_CHUNK_ATTEMPTS.
+        """
+        with self.cond:
+            self._settle(chunk_index, peer_key)
+            self._fail(chunk_index)
+            self.cond.notify_all()
+
+    def refuse(self, chunk_index, peer_key):
+        """
+        Puts back a chunk peer_key refused to send, for the other peers only.
+        Counts as an attempt, so a chunk nobody will send aborts the download.
+        """
+        with self.cond:
+            self._settle(chunk_index, peer_key)
+            self.refused.setdefault(chunk_index, set()).add(peer_key)
+            self._fail(chunk_index)
+            if not self.finished and self._stranded():
+                self._abort_stranded()
+            self.cond.notify_all()
+
+    def _fail(self, chunk_index):
+        if chunk_index not in self.needed:
+            return
+        self.attempts[chunk_index] += 1
+        if self.attempts[chunk_index] >= MAX_CHUNK_ATTEMPTS:
+            print(f"Failed to download chunk {chunk_index}. Aborting download.")
+            self.aborted = True
+        else:
+            self._requeue(chunk_index)
+
+    def withdraw(self, chunk_index):
+        """
+        Takes a chunk nobody has requested yet off the download, e.g. one filled from
+        local data. Returns False if it is already requested or done.
+        """
+        with self.cond:
+            if chunk_index not in self.pending or chunk_index in self.in_flight:
+                return False
+            self.pending.discard(chunk_index)
+            self.needed.discard(chunk_index)
+            self.cond.notify_all()
+            return True
+
+    def release(self, chunk_indices, peer_key):
+        """
+        Hands chunks owned by a failed or stalled peer back to the other workers.
+        """
+        with self.cond:
+            for chunk_index in chunk_indices:
+                self._settle(chunk_index, peer_key)
+                self._requeue(chunk_index)
+            self.cond.notify_all()
+
+def find_seeders(filename, peers):
+    """
+    Sends file_request to every peer in parallel.
+    Returns a list of (peer, file_info) for the peers that have the file.
+    """
+    def probe(peer):
         peer_addr = peer.get("address")
         peer_port = peer.get("port")
+        conn = None
         try:
-            print(f"Connecting to peer {peer_addr}:{peer_port} for file '{filename}'...")
-            s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            s.connect((peer_addr, peer_port))
-            message = {"action": "file_request", "filename": filename}
-            send_json(s, message)
-            response = recv_json(s)
-            s.close()
+            conn = PeerConnection(peer_addr, peer_port)
+            response = conn.request({"action": "file_request", "filename": filename, "binary": True, "merkle": True})
+            if response.get("action") == "collection_info":
+                return peer, response
             if response.get("action") == "file_info":
-                num_chunks = response.get("num_chunks")
-                chunk_hashes = response.get("chunk_hashes")
-                print(f"File info received: {num_chunks} chunks available.")
-                # Download each chunk
-                file_data = bytearray()
-                for i in range(num_chunks):
-                    success = False
-                    # Try to get each chunk (with simple retry logic)
-                    for attempt in range(3):
-                        try:
-                            s_chunk = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-                            s_chunk.connect((peer_addr, peer_port))
-                            chunk_request = {"action": "get_chunk", "filename": filename, "chunk_index": i}
-                            send_json(s_chunk, chunk_request)
-                            chunk_response = recv_json(s_chunk)
-                            s_chunk.close()
-                            if chunk_response.get("action") == "chunk_data":
-                                encoded_data = chunk_response.get("data")
-                                chunk_data = decode_chunk(encoded_data)
-                                # Verify integrity of the chunk
-                                if verify_chunk(chunk_data, chunk_hashes[i]):
-                                    file_data.extend(chunk_data)
-                                    print(f"Chunk {i+1}/{num_chunks} downloaded and verified.")
-                                    success = True
-                                    break
-                                else:
-                                    print(f"Chunk {i} failed integrity check. Retrying...")
-                        except Exception as e:
-                            print(f"Error downloading chunk {i} from {peer_addr}:{peer_port}: {e}")
-                    if not success:
-                        print(f"Failed to download chunk {i}. Aborting download.")
-                        return
-                # Save the assembled file into the files/ directory
-                file_path = os.path.join("files", filename)
-                with open(file_path, "wb") as f:
-                    f.write(file_data)
-                print(f"File '{filename}' downloaded successfully.")
-                return
-            else:
-                print(f"Peer {peer_addr}:{peer_port} does not have file '{filename}'.")
+                if "merkle_root" not in response:
+                    # Older peers send the full hash list; derive the root so all seeders compare the same way
+                    response["merkle_root"] = merkle_root(response.get("chunk_hashes"))
+                return peer, response
+            print(f"Peer {peer_addr}:{peer_port} does not have file '{filename}'.")
         except Exception as e:
             print(f"Error connecting to peer {peer_addr}:{peer_port}: {e}")
-    print(f"File '{filename}' not found on any peers.")
+            peer_directory.forget((peer_addr, peer_port))
+        finally:
+            if conn is not None:
+                conn.close()
+        return None
+
+    if not peers:
+        return []
+    with ThreadPoolExecutor(max_workers=min(len(peers), 32)) as pool:
+        return [result for result in pool.map(probe, peers) if result]
+
+class LazyChunkHashes:
+    """
+    Chunk hashes of a Merkle manifest. They are fetched from the seeders with
+    get_hashes in ranges of HASH_RANGE_SIZE on first use, and only kept once the
+    range proof checks out against the root from file_info. on_load, if set, is
+    called with (first chunk index, hashes) of each range as it is loaded, before
+    has() reports it, so no worker claims the range's chunks meanwhile.
+    """
+    def __init__(self, filename, file_info, seeders):
+        self.filename = filename
+        self.root = file_info.get("merkle_root")
+        self.num_chunks = file_info.get("num_chunks")
+        self.seeders = seeders
+        self.ranges = {}  # Format: { range_index: [hex hashes] }
+        self.on_load = None
+        self.lock = threading.Lock()
+
+    def __getitem__(self, chunk_index):
+        self.load(chunk_index)
+        return self.ranges[chunk_index // HASH_RANGE_SIZE][chunk_index % HASH_RANGE_SIZE]
+
+    def has(self, chunk_index):
+        return chunk_index // HASH_RANGE_SIZE in self.ranges
+
+    def load(self, chunk_index, conn=None):
+        """
+        Makes sure the hash range covering chunk_index is available. An idle
+        connection can be passed in so the range is fetched without opening a new one.
+        """
+        range_index = chunk_index // HASH_RANGE_SIZE
+        with self.lock:
+            if range_index not in self.ranges:
+                chunk_hashes = self._fetch(range_index * HASH_RANGE_SIZE, conn)
+                if self.on_load is not None:
+                    self.on_load(range_index * HASH_RANGE_SIZE, chunk_hashes)
+                self.ranges[range_index] = chunk_hashes
+
+    def _request_range(self, conn, start, end):
+        response = conn.request({"action": "get_hashes", "filename": self.filename, "start": start, "end": end})
+        if response.get("action") == "error":
+            # Partial peers can't prove hashes; another seeder will
+            return None
+        chunk_hashes = response.get("chunk_hashes") or []
+        if (response.get("action") == "hashes" and len(chunk_hashes) == end - start and
+                verify_merkle_range(self.root, self.num_chunks, start, chunk_hashes, response.get("proof", []))):
+            return chunk_hashes
+        print(f"Peer {conn.address}:{conn.port} sent invalid hashes for chunks {start}-{end - 1}.")
+        return None
+
+    def _fetch(self, start, conn=None):
+        end = min(start + HASH_RANGE_SIZE, self.num_chunks)
+        if conn is not None:
+            chunk_hashes = self._request_range(conn, start, end)
+            if chunk_hashes is not None:
+                return chunk_hashes
+        for peer, info in self.seeders:
+            if "chunk_hashes" in info:
+                # This seeder already sent the full list and its root matched
+                return info["chunk_hashes"][start:end]
+            peer_addr = peer.get("address")
+            peer_port = peer.get("port")
+            other = None
+            try:
+                other = PeerConnection(peer_addr, peer_port)
+                chunk_hashes = self._request_range(other, start, end)
+                if chunk_hashes is not None:
+                    return chunk_hashes
+            except Exception as e:
+                print(f"Error fetching hashes from {peer_addr}:{peer_port}: {e}")
+            finally:
+                if other is not None:
+                    other.close()
+        raise ConnectionError(f"No peer provided verified hashes for chunks {start}-{end - 1}")
+
+def swarm_worker(peer, file_info, chunk_hashes, scheduler, stats, on_chunk):
+    """
+    Fetches the chunks the scheduler assigns to one peer, with a pipeline sized
+    from the peer's measured throughput. Any chunks still outstanding when the
+    peer fails or stalls are released to the other workers.
+    """
+    peer_addr = peer.get("address")
+    peer_port = peer.get("port")
+    peer_key = (peer_addr, peer_port)
+    filename = file_info.get("filename")
+    lazy_hashes = isinstance(chunk_hashes, LazyChunkHashes)
+    # Ask for compressed chunks only if the peer advertised the codec
+    codec = preferred_codec if preferred_codec in file_info.get("codecs", []) else None
+    claimed = set()
+    # A claimed chunk whose hash range must be fetched once the pipeline drains
+    held = []
+    corrupt = 0
+
+    def claims():
+        while True:
+            chunk_index = scheduler.claim(peer_key, claimed)
+            if chunk_index is None:
+                return
+            claimed.add(chunk_index)
+            if lazy_hashes and not chunk_hashes.has(chunk_index):
+                held.append(chunk_index)
+                return
+            yield chunk_index
+
+    conn = None
+    try:
+        if file_info.get("persistent", False):
+            conn = PeerConnection(peer_addr, peer_port)
+        while True:
+            if not held:
+                # Block until the scheduler has something for this peer
+                chunk_index = scheduler.claim(peer_key, claimed, wait=True)
+                if chunk_index is None:
+                    break
+                claimed.add(chunk_index)
+                held.append(chunk_index)
+            if lazy_hashes and not chunk_hashes.has(held[0]):
+                # The connection is idle here, so fetch the hash range over it
+                # rather than opening another one the seed may not have room for
+                chunk_hashes.load(held[0], conn)
+            indices = itertools.chain([held.pop()], claims())
+            if conn is not None:
+                replies = conn.fetch_chunks(filename, indices, stats=stats, codec=codec,
+                                            chunk_size=file_info.get("chunk_size", CHUNK_SIZE))
+            else:
+                # Older peers close after one reply, so fall back to a connection per chunk
+                binary = file_info.get("binary", False)
+                replies = ((i, fetch_chunk(peer_addr, peer_port, filename, i, binary)) for i in indices)
+            for i, chunk_data in replies:
+                claimed.discard(i)
+                if chunk_data is None:
+                    # Refused, e.g. a partial peer that doesn't have it; someone else may serve it
+                    scheduler.refuse(i, peer_key)
+                # Verify integrity of the chunk
+                elif verify_chunk(chunk_data, chunk_hashes[i]):
+                    # on_chunk writes the chunk before completing it, so a failed write can't finish the download
+                    try:
+                        counted = on_chunk(i, chunk_data, peer_key)
+                    except Exception:
+                        scheduler.release([i], peer_key)
+                        raise
+                    # Endgame duplicates that lost the race are not counted
+                    if counted:
+                        verified_counter.inc()
+                else:
+                    print(f"Chunk {i} from {peer_addr}:{peer_port} failed integrity check. Retrying...")
+                    failed_counter.inc()
+                    scheduler.reject(i, peer_key)
+                    corrupt += 1
+                    if corrupt >= MAX_CHUNK_ATTEMPTS:
+                        raise ConnectionError("Too many corrupt chunks, dropping peer")
+    except Exception as e:
+        print(f"Error downloading chunks from {peer_addr}:{peer_port}: {e}")
+    finally:
+        scheduler.release(claimed, peer_key)
+        scheduler.leave(peer_key)
+        if conn is not None:
+            conn.close()
+
+class DownloadState:
+    """
+    Persistent record of a download: the manifest plus a bitmap of the chunks
+    already verified and written into the .part file. Lets `get` resume.
+    """
+    def __init__(self, path, manifest, bitmap=None):
+        self.path = path
+        self.manifest = manifest
+        self.bitmap = bitmap or ChunkBitmap(manifest["num_chunks"])
+        self.lock = threading.Lock()
+        self.save_lock = threading.Lock()
+        self.last_saved = time.monotonic()
+
+    @classmethod
+    def load(cls, path, manifest):
+        """
+        Returns the saved state at path if it describes the same manifest, else None.
+        """
+        try:
+            with open(path) as f:
+                saved = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if saved.get("manifest") != manifest:
+            return None
+        return cls(path, manifest, ChunkBitmap.decode(manifest["num_chunks"], saved["bitmap"]))
+
+    def mark(self, chunk_index):
+        """
+        Records a chunk as verified on disk. Returns True if the state is due to be saved.
+        """
+        with self.lock:
+            self.bitmap.set(chunk_index)
+            return time.monotonic() - self.last_saved >= STATE_SAVE_INTERVAL
+
+    def save(self):
+        """
+        Atomically rewrites the state file. Callers must fsync the .part file first,
+        so the bitmap never claims chunks that aren't durable.
+        """
+        with self.save_lock:
+            with self.lock:
+                state = {"manifest": self.manifest, "bitmap": self.bitmap.encode()}
+                self.last_saved = time.monotonic()
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(state, f)
+            os.replace(temp_path, self.path)
+
+class ChunkDeduplicator:
+    """
+    Fills missing chunks of a download from data this peer already holds under any
+    filename, and fetches chunks that repeat within the file only once. Chunks are
+    scanned as their hashes become known, a hash range at a time for lazily fetched
+    hashes, so deduplication never fetches hashes ahead of the download.
+    """
+    def __init__(self, scheduler, fd, chunk_size, state):
+        self.scheduler = scheduler
+        self.fd = fd
+        self.chunk_size = chunk_size
+        self.state = state
+        self.first = {}   # Format: { chunk hash: first missing chunk with it, which is fetched }
+        self.copies = {}  # Format: { fetched chunk: [chunks with the same hash, written along with it] }
+        self.reused = 0
+        self.repeated = 0
+        self.lock = threading.Lock()
+
+    def scan(self, start, chunk_hashes):
+        """
+        Deduplicates the chunks from start on whose hashes are chunk_hashes, skipping
+        those already requested or done. Returns the number of chunks written.
+        """
+        written = 0
+        with self.lock:
+            for i, chunk_hash in enumerate(chunk_hashes, start):
+                if i not in self.scheduler.pending:
+                    continue
+                j = self.first.get(chunk_hash)
+                if j is None:
+                    chunk_data = manifest_cache.find_chunk(chunk_hash)
+                    if chunk_data is None:
+                        self.first[chunk_hash] = i
+                        continue
+                    self.reused += 1
+                elif j in self.state.bitmap:
+                    # Its twin is on disk already, so copy it from the .part file
+                    chunk_data = read_at(self.fd, j * self.chunk_size, self.chunk_size)
+                    if not verify_chunk(chunk_data, chunk_hash):
+                        continue
+                    self.repeated += 1
+                else:
+                    # Written by take_copies once its twin arrives
+                    if self.scheduler.withdraw(i):
+                        self.copies.setdefault(j, []).append(i)
+                        self.repeated += 1
+                    continue
+                if self.scheduler.withdraw(i):
+                    write_at(self.fd, i * self.chunk_size, chunk_data)
+                    self.state.mark(i)
+                    written += 1
+        return written
+
+    def take_copies(self, chunk_index):
+        """
+        Returns the chunks to write with chunk_index. Call after marking it, so a scan
+        that misses the copies finds it on disk instead.
+        """
+        with self.lock:
+            return self.copies.pop(chunk_index, [])
+
+def download_file(filename, workers_per_peer=WORKERS_PER_PEER):
+    """
+    Downloads a file from every peer that has it, spreading chunk requests across them.
+    Seeders are looked up with who_has on the bootstrap server, or if that finds
+    none (e.g. the bootstrap is down) by probing the peers in the peer directory,
+    including those learned by peer exchange. Names that seeders share as
+    collections are fetched with download_collection.
+    Each seeder gets workers_per_peer connections, and a ChunkScheduler hands out
+    chunks rarest first, sizing each peer's pipeline from its measured throughput
+    and duplicating the last requests in endgame mode. Chunks owned by a peer that
+    fails or stalls are handed back to the remaining workers. Progress is kept in
+    files/<name>.state, so running it again after a failure only fetches missing chunks.
+    """
+    # Ask the bootstrap's content index first; fall back to probing every known peer
+    seeders = find_seeders(filename, who_has(filename))
+    if not seeders:
+        peers = get_peer_list()
+        if not peers:
+            print("No peers available.")
+            return
+        seeders = find_seeders(filename, peers)
+    if not seeders:
+        print(f"File '{filename}' not found on any peers.")
+        return
+    # Only swarm across peers whose manifest matches, so every chunk verifies the same way
+    file_info = seeders[0][1]
+    seeders = [(peer, info) for peer, info in seeders if info.get("merkle_root") == file_info.get("merkle_root")
+               and info.get("action") == file_info.get("action")]
+    if file_info.get("action") == "collection_info":
+        download_collection(filename, seeders, workers_per_peer)
+        return
+    num_chunks = file_info.get("num_chunks")
+    print(f"File info received: {num_chunks} chunks available from {len(seeders)} peer(s).")
+    if "chunk_hashes" in file_info:
+        chunk_hashes = file_info["chunk_hashes"]
+    else:
+        chunk_hashes = LazyChunkHashes(filename, file_info, seeders)
+
+    manifest = {
+        "filename": filename,
+        "file_size": file_info.get("file_size"),
+        "chunk_size": file_info.get("chunk_size", CHUNK_SIZE),
+        "num_chunks": num_chunks,
+        "merkle_root": file_info.get("merkle_root")
+    }
+    chunk_size = manifest["chunk_size"]
+    file_size = manifest["file_size"]
+    if not 0 < chunk_size <= MAX_CHUNK_SIZE or (file_size is not None and num_chunks != -(-file_size // chunk_size)):
+        print(f"Peer sent an invalid manifest for '{filename}' ({num_chunks} chunks of {chunk_size} bytes).")
+        return
+    file_path = os.path.join("files", filename)
+    # Verified chunks are written straight into a temp file at their offset, so memory
+    # stays bounded by the in-flight window rather than the file size
+    temp_path = file_path + ".part"
+    state_path = file_path + ".state"
+    state = DownloadState.load(state_path, manifest) if os.path.exists(temp_path) else None
+    flags = os.O_RDWR | os.O_CREAT | getattr(os, "O_BINARY", 0)
+    if state is None:
+        state = DownloadState(state_path, manifest)
+        flags |= os.O_TRUNC
+    fd = os.open(temp_path, flags, 0o644)
+    if manifest["file_size"] is not None:
+        preallocate(fd, manifest["file_size"])
+    state.save()
+
+    missing = state.bitmap.missing()
+    if len(missing) < num_chunks:
+        print(f"Resuming download: {num_chunks - len(missing)}/{num_chunks} chunks already on disk.")
+    haves = {}
+    for peer, info in list(seeders):
+        # Partial peers send a bitmap of the chunks they hold; full seeders send none
+        key = (peer.get("address"), peer.get("port"))
+        if "have" not in info:
+            haves[key] = None
+            continue
+        try:
+            have = ChunkBitmap.decode(num_chunks, info["have"])
+        except (AttributeError, TypeError, ValueError):
+            have = None
+        if have is None or len(have.bits) != (num_chunks + 7) // 8:
+            print(f"Peer {key[0]}:{key[1]} sent an invalid chunk bitmap; not using it.")
+            seeders.remove((peer, info))
+            continue
+        haves[key] = have
+    scheduler = ChunkScheduler(num_chunks, missing, haves)
+    progress_lock = threading.Lock()
+    done = [num_chunks - len(missing)]
+    deduper = None
+    if dedup_enabled and missing:
+        deduper = ChunkDeduplicator(scheduler, fd, chunk_size, state)
+        if isinstance(chunk_hashes, LazyChunkHashes):
+            # Each hash range is deduplicated once a worker has fetched it for its own chunks
+            def on_load(start, range_hashes):
+                written = deduper.scan(start, range_hashes)
+                with progress_lock:
+                    done[0] += written
+            chunk_hashes.on_load = on_load
+        else:
+            done[0] += deduper.scan(0, chunk_hashes)
+    peer_stats = {key: PeerStats(chunk_size, REGISTRY.histogram("chunk_latency_seconds", f"peer={key[0]}:{key[1]}"))
+                  for key in haves}
+    # While downloading, this peer serves the chunks it already has to others
+    active_downloads[filename] = {"state": state, "temp_path": temp_path}
+    announce_files([filename])
+    transfers[filename] = {"status": "downloading", "chunks_done": done[0], "num_chunks": num_chunks}
+
+    def on_chunk(i, chunk_data, peer_key):
+        # Written and marked first, then completed; returns False for a duplicate that lost the race
+        write_at(fd, i * chunk_size, chunk_data)
+        due = state.mark(i)
+        copies = deduper.take_copies(i) if deduper is not None else []
+        for j in copies:
+            write_at(fd, j * chunk_size, chunk_data)
+            due = state.mark(j) or due
+        if due:
+            os.fsync(fd)
+            state.save()
+        won = scheduler.complete(i, peer_key)
+        with progress_lock:
+            done[0] += len(copies) + won
+            if not won:
+                return False
+            transfers[filename]["chunks_done"] = done[0]
+            print(f"Chunk {done[0]}/{num_chunks} downloaded and verified.")
+        return True
+
+    try:
+        # Every worker is counted before any starts, so none can find the others gone and abort early
+        for peer, info in seeders:
+            for _ in range(workers_per_peer):
+                scheduler.join((peer.get("address"), peer.get("port")))
+        workers = []
+        for peer, info in seeders:
+            for _ in range(workers_per_peer):
+                stats = peer_stats[(peer.get("address"), peer.get("port"))]
+                worker = threading.Thread(target=swarm_worker, args=(peer, info, chunk_hashes, scheduler, stats, on_chunk),
+                                          daemon=True)
+                worker.start()
+                workers.append(worker)
+        for worker in workers:
+            worker.join()
+        os.fsync(fd)
+    finally:
+        active_downloads.pop(filename, None)
+        os.close(fd)
+        if scheduler.remaining and filename not in shared_files:
+            # Nothing can be served from the .part file any more, so stop pointing downloaders here
+            unannounce_files([filename])
+    for (peer_addr, peer_port), stats in peer_stats.items():
+        print(f"Peer {peer_addr}:{peer_port}: {stats.bytes_received / (1024 * 1024):.1f} MB ({stats.describe()}).")
+    if deduper is not None and (deduper.reused or deduper.repeated):
+        print(f"Deduplicated: {deduper.reused} chunks copied from local files, {deduper.repeated} repeated chunks fetched once.")
+
+    if scheduler.remaining or state.bitmap.count() != num_chunks:
+        if not scheduler.aborted:
+            print(f"All peers failed with {num_chunks - state.bitmap.count()} chunks missing. Aborting download.")
+        # Keep the .part file and record what it holds so the next `get` resumes
+        state.save()
+        transfers[filename]["status"] = "incomplete"
+        print(f"Run 'get {filename}' again to resume ({done[0]}/{num_chunks} chunks saved).")
+        return
+    # Move the completed file into the files/ directory in one atomic step
+    os.replace(temp_path, file_path)
+    os.remove(state_path)
+    try:
+        # Index the new file's chunks for later downloads; sharing it won't need to hash it either
+        manifest_cache.add(file_path, [chunk_hashes[i] for i in range(num_chunks)], chunk_size)
+    except ConnectionError as e:
+        print(f"Could not index '{filename}': {e}")
+    # It was announced while downloading, so keep serving it now that it's complete
+    shared_files[filename] = manifest_cache.get(file_path, chunk_size)
+    transfers[filename]["status"] = "complete"
+    print(f"File '{filename}' downloaded successfully.")
+
+class BatchQueue:
+    """
+    Chunks still to fetch for a collection download, handed to workers in batches
+    of up to BATCH_CHUNKS chunks and BATCH_BYTES bytes. Items are tuples
+    (path, chunk_index, length, file number). Chunks of a failed batch go back
+    on the queue, up to MAX_CHUNK_ATTEMPTS tries each.
+    """
+    def __init__(self, items):
+        self.items = deque(items)
+        self.attempts = {}
+        self.outstanding = 0  # Items handed out and not yet finished
+        self.failed = 0       # Items given up on
+        self.cond = threading.Condition()
+
+    def take(self, wait=False):
+        """
+        Returns the next batch, or None if the queue is empty. With wait, blocks
+        while batches held by other workers may still come back.
+        """
+        with self.cond:
+            while wait and not self.items and self.outstanding:
+                self.cond.wait()
+            batch = []
+            size = 0
+            while self.items and len(batch) < BATCH_CHUNKS and (not batch or size + self.items[0][2] <= BATCH_BYTES):
+                item = self.items.popleft()
+                batch.append(item)
+                size += item[2]
+            self.outstanding += len(batch)
+            return batch or None
+
+    def finish(self, batch, failed=()):
+        """
+        Marks a batch as done, putting the failed items back on the queue.
+        """
+        with self.cond:
+            for item in failed:
+                key = (item[3], item[1])
+                self.attempts[key] = self.attempts.get(key, 0) + 1
+                if self.attempts[key] < MAX_CHUNK_ATTEMPTS:
+                    self.items.append(item)
+                else:
+                    self.failed += 1
+            self.outstanding -= len(batch)
+            self.cond.notify_all()
+
+def collection_worker(peer, info, entries, queue, on_chunk):
+    """
+    Fetches batches of a collection's chunks from one peer over a single
+    connection, with BATCH_WINDOW get_batch requests in flight.
+    """
+    peer_addr = peer.get("address")
+    peer_port = peer.get("port")
+    codec = preferred_codec if preferred_codec in info.get("codecs", []) else None
+    taken = deque()  # Batches sent and not yet answered, in order
+    corrupt = 0
+
+    def batches():
+        while True:
+            batch = queue.take()
+            if batch is None:
+                return
+            taken.append(batch)
+            yield batch
+
+    conn = None
+    try:
+        conn = PeerConnection(peer_addr, peer_port)
+        while True:
+            batch = queue.take(wait=True)
+            if batch is None:
+                break
+            taken.append(batch)
+            for batch, payloads in conn.fetch_batches(info.get("filename"), itertools.chain([taken[0]], batches()),
+                                                      codec=codec):
+                failed = []
+                done = 0
+                try:
+                    for item, chunk_data in zip(batch, payloads):
+                        if chunk_data is None:
+                            failed.append(item)
+                        elif verify_chunk(chunk_data, entries[item[3]]["chunk_hashes"][item[1]]):
+                            verified_counter.inc()
+                            on_chunk(item, chunk_data)
+                        else:
+                            print(f"Chunk {item[1]} of '{item[0]}' from {peer_addr}:{peer_port} failed integrity check. Retrying...")
+                            failed_counter.inc()
+                            failed.append(item)
+                            corrupt += 1
+                        done += 1
+                finally:
+                    # Finished even if on_chunk raised, so other workers waiting in take() aren't stranded;
+                    # items not handled yet go back without counting as an attempt
+                    taken.popleft()
+                    with queue.cond:
+                        queue.items.extend(batch[done:])
+                    queue.finish(batch, failed)
+                if corrupt >= MAX_CHUNK_ATTEMPTS:
+                    raise ConnectionError("Too many corrupt chunks, dropping peer")
+    except Exception as e:
+        print(f"Error downloading collection chunks from {peer_addr}:{peer_port}: {e}")
+    finally:
+        # Whatever this peer still owed goes back for the other workers, without counting as an attempt
+        while taken:
+            batch = taken.popleft()
+            with queue.cond:
+                queue.items.extend(batch)
+            queue.finish(batch)
+        if conn is not None:
+            conn.close()
+
+def valid_collection_path(path):
+    """
+    Checks that a path from a peer's collection manifest stays inside the collection directory.
+    """
+    if not isinstance(path, str) or not path or "\\" in path or ":" in path or "\0" in path:
+        return False
+    return all(part not in ("", ".", "..") for part in path.split("/"))
+
+def download_collection(name, seeders, workers_per_peer=WORKERS_PER_PEER):
+    """
+    Downloads a collection into files/<name> from the peers that share it, using
+    the one manifest in their collection_info. Chunks of many files are requested
+    together with get_batch over a few long-lived connections per peer, so small
+    files don't each pay for a lookup, a manifest and a round trip. Files already
+    on disk with the same hashes are skipped, which also resumes an interrupted
+    download file by file.
+    """
+    entries = seeders[0][1].get("files") or []
+    try:
+        paths = set()
+        for entry in entries:
+            chunk_size = entry["chunk_size"]
+            if (not valid_collection_path(entry["path"]) or entry["path"] in paths or not 0 < chunk_size <= MAX_CHUNK_SIZE
+                    or len(entry["chunk_hashes"]) != -(-entry["file_size"] // chunk_size)):
+                raise ValueError(f"bad entry {entry['path']!r}")
+            paths.add(entry["path"])
+        if collection_root(entries) != seeders[0][1].get("merkle_root"):
+            raise ValueError("files don't match the collection's Merkle root")
+    except (KeyError, TypeError, ValueError) as e:
+        print(f"Peer sent an invalid manifest for collection '{name}': {e}")
+        return
+    base = os.path.join("files", name)
+    items = []
+    remaining = {}  # Format: { file number: chunks not yet written }
+    copies = {}     # Format: { (file number, chunk index): [(file number, chunk index) with the same hash] }
+    first = {}      # Format: { chunk hash: (file number, chunk index) fetched for it }
+    local = []      # Chunks copied from files this peer already holds
+    skipped = 0
+    for n, entry in enumerate(entries):
+        target = os.path.join(base, *entry["path"].split("/"))
+        existing = manifest_cache.get(target, entry["chunk_size"], batch=True) if os.path.isfile(target) else None
+        if existing is not None and existing["chunk_hashes"] == entry["chunk_hashes"]:
+            skipped += 1
+            continue
+        remaining[n] = len(entry["chunk_hashes"])
+        for i, chunk_hash in enumerate(entry["chunk_hashes"]):
+            if chunk_hash in first:
+                copies.setdefault(first[chunk_hash], []).append((n, i))
+                continue
+            first[chunk_hash] = (n, i)
+            length = min(entry["chunk_size"], entry["file_size"] - i * entry["chunk_size"])
+            if dedup_enabled:
+                chunk_data = manifest_cache.find_chunk(chunk_hash)
+                if chunk_data is not None:
+                    local.append(((entry["path"], i, length, n), chunk_data))
+                    continue
+            items.append((entry["path"], i, length, n))
+    num_chunks = sum(remaining.values())
+    print(f"Collection info received: {len(entries)} files ({skipped} already present), {num_chunks} chunks "
+          f"to fetch from {len(seeders)} peer(s).")
+
+    lock = threading.Lock()
+    fds = {}  # Format: { file number: fd of its .part file }, open only while the file is in progress
+    done = [0, skipped]  # Chunks written, files complete
+    transfers[name] = {"status": "downloading", "chunks_done": 0, "num_chunks": num_chunks}
+
+    def finish_file(n):
+        entry = entries[n]
+        target = os.path.join(base, *entry["path"].split("/"))
+        os.replace(target + ".part", target)
+        manifest_cache.add(target, entry["chunk_hashes"], entry["chunk_size"])
+        done[1] += 1
+        print(f"File {done[1]}/{len(entries)} '{entry['path']}' downloaded and verified.")
+
+    def on_chunk(item, chunk_data):
+        _, i, _, n = item
+        with lock:
+            for m, j in [(n, i)] + copies.get((n, i), []):
+                fd = fds.get(m)
+                if fd is None:
+                    target = os.path.join(base, *entries[m]["path"].split("/"))
+                    os.makedirs(os.path.dirname(target), exist_ok=True)
+                    fd = fds[m] = os.open(target + ".part", os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_BINARY", 0), 0o644)
+                    preallocate(fd, entries[m]["file_size"])
+                write_at(fd, j * entries[m]["chunk_size"], chunk_data)
+                remaining[m] -= 1
+                done[0] += 1
+                if not remaining[m]:
+                    os.close(fds.pop(m))
+                    finish_file(m)
+            transfers[name]["chunks_done"] = done[0]
+
+    try:
+        # Empty files have no chunks to wait for
+        for n in [n for n, left in remaining.items() if not left]:
+            target = os.path.join(base, *entries[n]["path"].split("/"))
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            open(target + ".part", "wb").close()
+            finish_file(n)
+        for item, chunk_data in local:
+            on_chunk(item, chunk_data)
+        if local:
+            print(f"Deduplicated: {len(local)} chunks copied from local files.")
+        queue = BatchQueue(items)
+        workers = []
+        for peer, info in seeders:
+            for _ in range(workers_per_peer):
+                worker = threading.Thread(target=collection_worker, args=(peer, info, entries, queue, on_chunk), daemon=True)
+                worker.start()
+                workers.append(worker)
+        for worker in workers:
+            worker.join()
+    finally:
+        with lock:
+            for n, fd in fds.items():
+                os.close(fd)
+        manifest_cache.save()
+
+    incomplete = sum(1 for left in remaining.values() if left)
+    if incomplete:
+        transfers[name]["status"] = "incomplete"
+        print(f"All peers failed with {incomplete} files incomplete. "
+              f"Run 'get {name}' again to resume ({done[1]}/{len(entries)} files saved).")
+        return
+    transfers[name]["status"] = "complete"
+    print(f"Collection '{name}' downloaded successfully.")
 
 def print_status():
     """
-    Prints the current transfer status (placeholder for more detailed tracking).
+    Prints the current transfer status.
     """
     print("Current transfers:")
     if not transfers:
         print("No active transfers.")
     else:
         for filename, status in transfers.items():
-            print(f"{filename}: {status}")
+            print(f"{filename}: {status['status']} ({status['chunks_done']}/{status['num_chunks']} chunks)")
+    rate, peer_rate, slots, peers = uploads.snapshot()
+    print(f"Uploads (limit {format_rate(rate)}, per peer {format_rate(peer_rate)}, slots {slots or 'unlimited'}):")
+    if not peers:
+        print("No uploads yet.")
+    for peer, (served, queued, active) in peers.items():
+        print(f"{peer}: {served / (1024 * 1024):.1f} MB served, {active} sending, {queued} queued")
+    print_metrics()
+    known, exchanged, version, age = peer_directory.snapshot()
+    refreshed = f"refreshed {age:.0f}s ago" if age is not None else "not loaded yet"
+    print(f"Peer directory: {known} peers from the bootstrap at version {version}, {refreshed} "
+          f"(TTL {peer_directory.ttl:g}s); {exchanged} from peer exchange")
+    cached, budget, hits, misses, evictions = chunk_cache.snapshot()
+    hit_rate = hits / (hits + misses) * 100 if hits + misses else 0
+    print(f"Chunk cache: {cached / (1024 * 1024):.1f}/{budget / (1024 * 1024):.0f} MB, "
+          f"{hits} hits, {misses} misses ({hit_rate:.0f}% hit rate), {evictions} evictions")
+
+def print_metrics():
+    """
+    Prints traffic counters and per-peer chunk latency from the metrics registry.
+    """
+    snapshot = REGISTRY.snapshot()
+    counters = snapshot["counters"]
+    print(f"Traffic: {counters['bytes_in'] / (1024 * 1024):.1f} MB in, {counters['bytes_out'] / (1024 * 1024):.1f} MB out; "
+          f"chunks {counters['chunks_verified']} verified, {counters['chunks_failed']} failed, "
+          f"{counters['chunks_served']} served; {snapshot['gauges']['active_connections']} connections")
+    for key, histogram in snapshot["histograms"].items():
+        # Seeders that delivered nothing (e.g. every chunk was deduplicated) have no percentiles
+        if key.startswith("chunk_latency_seconds") and histogram["count"]:
+            print(f"Latency {key[len('chunk_latency_seconds{peer='):-1]}: p50 {histogram['p50'] * 1000:g} ms, "
+                  f"p95 {histogram['p95'] * 1000:g} ms ({histogram['count']} chunks)")
+
+def format_rate(rate):
+    return f"{rate / 1024:.0f} KB/s" if rate else "unlimited"
+
+def set_upload_limit(args):
+    """
+    Handles the 'limit' command: limit <upload|peer|slots|peer-slots> <value>, with rates in KB/s and 0 for unlimited.
+    """
+    if len(args) != 2 or args[0] not in ("upload", "peer", "slots", "peer-slots") or not args[1].isdigit():
+        print("Usage: limit <upload|peer|slots|peer-slots> <value>  (rates in KB/s, 0 = unlimited)")
+        return
+    value = int(args[1])
+    if args[0] == "upload":
+        uploads.set_limits(rate=value * 1024)
+    elif args[0] == "peer":
+        uploads.set_limits(peer_rate=value * 1024)
+    elif args[0] == "slots":
+        uploads.set_limits(slots=value)
+    else:
+        uploads.set_limits(peer_slots=value)
+    print(f"Upload {args[0]} limit set to {value or 'unlimited'}.")
 
 def cli_loop(my_address, my_port):
     """
@@ -221,10 +2544,13 @@ def cli_loop(my_address, my_port):
     """
     help_text = """
 Available commands:
-  share <filename>   - Share a file (ensure the file is in the 'files/' directory).
+  share <filename>   - Share a file (ensure the file is in the 'files/' directory);
+                       a directory there is shared as one collection.
   list-peers         - List active peers from the bootstrap server.
-  get <filename>     - Download a file from peers.
-  status             - Show current file transfer status.
+  get <filename>     - Download a file or collection from peers.
+  status             - Show current file transfer status and per-peer uploads.
+  limit <upload|peer|slots> <value>
+                     - Change the total or per-peer upload rate (KB/s) or upload slots; 0 = unlimited.
   exit               - Exit the program.
 """
     print(help_text)
@@ -252,26 +2578,77 @@ Available commands:
                 download_file(parts[1])
             elif cmd == "status":
                 print_status()
+            elif cmd == "limit":
+                set_upload_limit(parts[1:])
             elif cmd == "exit":
                 print("Exiting.")
+                manifest_cache.save()
                 os._exit(0)
             else:
                 print("Unknown command.")
         except KeyboardInterrupt:
             print("Exiting.")
+            manifest_cache.save()
             os._exit(0)
 
 def main():
+    global BOOTSTRAP_SERVER, dedup_enabled, preferred_codec, share_chunk_size
     ensure_files_dir()
+    parser = argparse.ArgumentParser(description="P2P file sharing peer node")
+    parser.add_argument("port", nargs="?", type=int, default=10000, help="Port to listen on (default: 10000)")
+    parser.add_argument("--bootstrap", default=f"{BOOTSTRAP_SERVER[0]}:{BOOTSTRAP_SERVER[1]}",
+                        help="Bootstrap server as host:port (default: %(default)s)")
+    parser.add_argument("--server", choices=["thread", "async"], default="thread",
+                        help="Serve peers with a thread per connection or on an asyncio event loop")
+    parser.add_argument("--max-connections", type=int, default=MAX_CONNECTIONS,
+                        help="Peer connections served at once; extra connections wait")
+    parser.add_argument("--backlog", type=int, default=SERVER_BACKLOG, help="Listen backlog of the peer server")
+    parser.add_argument("--upload-rate", type=int, default=UPLOAD_RATE // 1024,
+                        help="Total upload limit in KB/s (default: 0, unlimited)")
+    parser.add_argument("--peer-upload-rate", type=int, default=PEER_UPLOAD_RATE // 1024,
+                        help="Upload limit per downloading peer in KB/s (default: 0, unlimited)")
+    parser.add_argument("--upload-slots", type=int, default=UPLOAD_SLOTS,
+                        help=f"Chunks sent at once; 0 = unlimited (default: {UPLOAD_SLOTS})")
+    parser.add_argument("--peer-upload-slots", type=int, default=PEER_UPLOAD_SLOTS,
+                        help=f"Chunks sent at once to one peer; 0 = unlimited (default: {PEER_UPLOAD_SLOTS})")
+    parser.add_argument("--chunk-cache", type=int, default=CHUNK_CACHE_BYTES // (1024 * 1024),
+                        help=f"Memory for recently served chunks in MB; 0 disables it (default: {CHUNK_CACHE_BYTES // (1024 * 1024)})")
+    parser.add_argument("--dedup", action=argparse.BooleanOptionalAction, default=True,
+                        help="Copy chunks already held in local files instead of downloading them (default: on)")
+    parser.add_argument("--codec", choices=["none"] + list(CODECS), default="none",
+                        help="Ask seeds to compress chunks with this codec when it helps (default: none)")
+    parser.add_argument("--chunk-size", type=int, default=0,
+                        help="Chunk size in KB for files shared from now on (default: 0, chosen from each file's size)")
+    parser.add_argument("--peer", action="append", default=[], metavar="HOST:PORT",
+                        help="A peer to exchange peers with even if the bootstrap server is unreachable (repeatable)")
+    parser.add_argument("--peer-cache-ttl", type=float, default=PEER_CACHE_TTL,
+                        help=f"Seconds the peer list is cached before asking the bootstrap again; 0 = always ask (default: {PEER_CACHE_TTL})")
+    parser.add_argument("--metrics-file", help="Write a JSON snapshot of the metrics to this file periodically")
+    parser.add_argument("--metrics-interval", type=float, default=10, help="Seconds between metrics snapshots (default: 10)")
+    args = parser.parse_args()
+    if not 0 <= args.chunk_size * 1024 <= MAX_CHUNK_SIZE:
+        parser.error(f"--chunk-size must be at most {MAX_CHUNK_SIZE // 1024} KB")
+    host, _, port = args.bootstrap.rpartition(":")
+    BOOTSTRAP_SERVER = (host, int(port))
+    if args.metrics_file:
+        REGISTRY.start_dump(args.metrics_file, args.metrics_interval)
+    dedup_enabled = args.dedup
+    preferred_codec = None if args.codec == "none" else args.codec
+    share_chunk_size = args.chunk_size * 1024 or None
+    chunk_cache.resize(args.chunk_cache * 1024 * 1024)
+    peer_directory.ttl = args.peer_cache_ttl
+    for peer in args.peer:
+        host, _, port = peer.rpartition(":")
+        peer_directory.merge([{"address": host, "port": int(port)}], direct=True)
+    uploads.set_limits(args.upload_rate * 1024, args.peer_upload_rate * 1024, args.upload_slots, args.peer_upload_slots)
     # Determine the local IP (for simplicity, using localhost) and port
     my_address = "127.0.0.1"
-    my_port = 10000  # Default port; you can pass a different port as a command-line argument
-    if len(sys.argv) > 1:
-        my_port = int(sys.argv[1])
+    my_port = args.port
     # Register with the bootstrap server
     register_with_bootstrap(my_address, my_port)
     # Start the server listener in a separate thread
-    server_thread = threading.Thread(target=server_listener, args=(my_port,), daemon=True)
+    listener = async_server_listener if args.server == "async" else server_listener
+    server_thread = threading.Thread(target=listener, args=(my_port, args.max_connections, args.backlog), daemon=True)
     server_thread.start()
     # Start the CLI loop in the main thread
     cli_loop(my_address, my_port)
@@ -2,10 +2,44 @@
 import json
 import socket
 import base64
+import bz2
 import hashlib
+import lzma
 import os
+import select
+import struct
+import threading
+import time
+import zlib
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
-CHUNK_SIZE = 64 * 1024  # 64KB per chunk
+CHUNK_SIZE = 64 * 1024  # 64KB per chunk; assumed for peers whose file_info has no chunk_size
+# Per-file chunk sizes are powers of two in this range, picked so a file has at most TARGET_CHUNKS chunks
+MIN_CHUNK_SIZE = CHUNK_SIZE
+MAX_CHUNK_SIZE = 4 * 1024 * 1024
+TARGET_CHUNKS = 256
+HASH_READ_SIZE = 8 * 1024 * 1024  # Sequential read size used when hashing a file
+
+# Binary frame header: message type, flags, chunk index, payload length.
+# The type byte never collides with '{', so a frame can't be mistaken for JSON.
+FRAME_HEADER = struct.Struct("!BBII")
+FRAME_CHUNK = 0x01  # Payload is raw chunk data
+FRAME_ERROR = 0x02  # Payload is a UTF-8 error message
+
+# Chunk codecs and the value naming each in a frame's flags byte; 0 means uncompressed
+CODECS = {"zlib": 1, "bz2": 2, "lzma": 3}
+# A chunk is only sent compressed if that makes it smaller than this fraction of its size
+COMPRESS_RATIO = 0.9
+# Bytes compressed to test whether a chunk is worth compressing at all
+COMPRESS_PROBE_SIZE = 4096
+
+# Initial receive buffer of a MessageReader, and the largest message it grows to hold
+READ_BUFFER_SIZE = 64 * 1024
+MAX_MESSAGE_SIZE = 256 * 1024 * 1024
+
+# Serializes seek+read/write on platforms without os.pread/os.pwrite
+_SEEK_LOCK = threading.Lock()
 
 def send_json(sock, message):
     """
@@ -16,23 +50,187 @@ def send_json(sock, message):
 
 def recv_json(sock):
     """
-    Receive a JSON message from a socket. Assumes messages are newline-delimited.
+    Receive one JSON message from a socket. Assumes messages are newline-delimited.
+    Bytes after the message are dropped with the reader, so use a MessageReader
+    for connections that carry more than one reply.
     """
-    buffer = ""
-    while True:
-        data = sock.recv(1024).decode()
-        if not data:
-            break
-        buffer += data
-        if "\n" in buffer:
-            line, buffer = buffer.split("\n", 1)
-            return json.loads(line)
-    return None
+    return MessageReader(sock).read_message()
+
+class MessageReader:
+    """
+    Per-connection reader for newline-delimited JSON messages and binary frames.
+
+    Data is received with recv_into straight into one preallocated bytearray, and
+    bytes that arrive after a message stay buffered for the next read, so pipelined
+    replies are never lost. Each read scans only newly received bytes for the
+    delimiter, so a large message costs linear time; the buffer doubles when a
+    message doesn't fit and is compacted in place otherwise.
+    """
+    def __init__(self, sock, size=READ_BUFFER_SIZE):
+        self.sock = sock
+        self.buffer = bytearray(size)
+        self.view = memoryview(self.buffer)
+        self.start = 0  # First unread byte
+        self.end = 0    # End of the received data
+
+    def _fill(self):
+        """
+        Receives more data after what is buffered. Returns the number of bytes received.
+        """
+        if self.end == len(self.buffer):
+            unread = self.end - self.start
+            if self.start:
+                # Move the unread tail to the front (memoryview copies handle the overlap)
+                self.view[:unread] = self.view[self.start:self.end]
+            else:
+                if len(self.buffer) >= MAX_MESSAGE_SIZE:
+                    raise ValueError(f"Message larger than {MAX_MESSAGE_SIZE} bytes")
+                grown = bytearray(len(self.buffer) * 2)
+                grown[:unread] = self.view[:unread]
+                self.buffer = grown
+                self.view = memoryview(grown)
+            self.start = 0
+            self.end = unread
+        n = self.sock.recv_into(self.view[self.end:])
+        self.end += n
+        return n
+
+    def _consume(self, size):
+        self.start += size
+        if self.start == self.end:
+            self.start = self.end = 0
+
+    def read_message(self):
+        """
+        Returns the next JSON message, or None if the connection closed cleanly.
+        """
+        scanned = 0
+        while True:
+            newline = self.buffer.find(b"\n", self.start + scanned, self.end)
+            if newline >= 0:
+                # json.loads parses bytes directly; no str is built for the line
+                message = json.loads(self.buffer[self.start:newline])
+                self._consume(newline + 1 - self.start)
+                return message
+            scanned = self.end - self.start
+            if not self._fill():
+                if self.end > self.start:
+                    raise ConnectionError("Connection closed in the middle of a message")
+                return None
+
+    def read_exact(self, size):
+        """
+        Returns exactly size bytes as a bytearray. Whatever isn't buffered yet is
+        received straight into the result rather than through the buffer.
+        Raises ConnectionError if the peer closes the connection early.
+        """
+        buffered = self.end - self.start
+        if buffered >= size:
+            data = self.buffer[self.start:self.start + size]
+            self._consume(size)
+            return data
+        data = bytearray(size)
+        data[:buffered] = self.view[self.start:self.end]
+        self.start = self.end = 0
+        view = memoryview(data)
+        received = buffered
+        while received < size:
+            n = self.sock.recv_into(view[received:], size - received)
+            if n == 0:
+                raise ConnectionError("Connection closed while receiving frame")
+            received += n
+        return data
+
+    def read_frame(self):
+        """
+        Receive a binary frame. Returns (frame_type, flags, chunk_index, payload).
+        """
+        while self.end - self.start < FRAME_HEADER.size:
+            if not self._fill():
+                raise ConnectionError("Connection closed while receiving frame")
+        frame_type, flags, chunk_index, length = FRAME_HEADER.unpack_from(self.buffer, self.start)
+        self._consume(FRAME_HEADER.size)
+        payload = self.read_exact(length) if length else bytearray()
+        return frame_type, flags, chunk_index, payload
+
+def pack_frame_header(frame_type, chunk_index, length, flags=0):
+    """
+    Build the fixed-size header that precedes a binary frame payload.
+    """
+    return FRAME_HEADER.pack(frame_type, flags, chunk_index, length)
+
+def send_frame(sock, frame_type, chunk_index, payload, flags=0):
+    """
+    Send a binary frame: header followed by the raw payload.
+    Header and payload go out in one gathered write so the payload isn't copied,
+    or in two sends where sendmsg isn't available (e.g. Windows).
+    """
+    header = pack_frame_header(frame_type, chunk_index, len(payload), flags)
+    if not hasattr(sock, "sendmsg"):
+        sock.sendall(header)
+        sock.sendall(payload)
+        return
+    parts = [memoryview(header), memoryview(payload).cast("B")]
+    while parts:
+        sent = sock.sendmsg(parts)
+        while parts and sent >= len(parts[0]):
+            sent -= len(parts[0])
+            parts.pop(0)
+        if parts and sent:
+            parts[0] = parts[0][sent:]
 
-def chunk_file(filepath, chunk_size=CHUNK_SIZE):
+def compress_chunk(chunk_data, codec):
+    """
+    Compress a chunk with the named codec. Returns None if it doesn't shrink below
+    COMPRESS_RATIO; a quick zlib pass over the first few KB rejects random or
+    already-compressed data without compressing the whole chunk.
+    """
+    if len(chunk_data) > 2 * COMPRESS_PROBE_SIZE:
+        probe = zlib.compress(chunk_data[:COMPRESS_PROBE_SIZE], 1)
+        if len(probe) > COMPRESS_PROBE_SIZE * COMPRESS_RATIO:
+            return None
+    if codec == "zlib":
+        compressed = zlib.compress(chunk_data)
+    elif codec == "bz2":
+        compressed = bz2.compress(chunk_data)
+    else:
+        compressed = lzma.compress(chunk_data)
+    return compressed if len(compressed) < len(chunk_data) * COMPRESS_RATIO else None
+
+def decompress_chunk(payload, flags, max_size):
+    """
+    Undo compress_chunk for a frame whose flags name the codec used (0 = not compressed).
+    Output is capped at max_size, so a bogus payload can't blow up memory; it just fails verification.
+    """
+    if not flags:
+        return payload
+    if flags == CODECS["zlib"]:
+        decompressor = zlib.decompressobj()
+    elif flags == CODECS["bz2"]:
+        decompressor = bz2.BZ2Decompressor()
+    elif flags == CODECS["lzma"]:
+        decompressor = lzma.LZMADecompressor()
+    else:
+        raise ValueError(f"Unknown chunk codec {flags}")
+    return decompressor.decompress(payload, max_size)
+
+def choose_chunk_size(file_size):
+    """
+    Returns the chunk size for a file of file_size bytes: the smallest power of two
+    from MIN_CHUNK_SIZE up to MAX_CHUNK_SIZE that splits it into at most TARGET_CHUNKS chunks.
+    Small files keep small chunks; huge files don't need hundreds of thousands of requests and hashes.
+    """
+    chunk_size = MIN_CHUNK_SIZE
+    while chunk_size < MAX_CHUNK_SIZE and file_size > chunk_size * TARGET_CHUNKS:
+        chunk_size *= 2
+    return chunk_size
+
+def chunk_file(filepath, chunk_size=None):
     """
     Generator that yields (chunk_index, chunk_data, chunk_hash) for each chunk.
+    The chunk size defaults to choose_chunk_size for the file.
     """
+    chunk_size = chunk_size or choose_chunk_size(os.path.getsize(filepath))
     with open(filepath, "rb") as f:
         index = 0
         while True:
@@ -43,10 +241,12 @@ def chunk_file(filepath, chunk_size=CHUNK_SIZE):
             yield index, chunk, chunk_hash
             index += 1
 
-def split_file(filepath, chunk_size=CHUNK_SIZE):
+def split_file(filepath, chunk_size=None):
     """
     Splits a file into chunks and returns a tuple: (list_of_chunks, list_of_chunk_hashes).
+    The chunk size defaults to choose_chunk_size for the file.
     """
+    chunk_size = chunk_size or choose_chunk_size(os.path.getsize(filepath))
     chunks = []
     chunk_hashes = []
     with open(filepath, "rb") as f:
@@ -58,6 +258,72 @@ def split_file(filepath, chunk_size=CHUNK_SIZE):
             chunk_hashes.append(hashlib.sha256(chunk).hexdigest())
     return chunks, chunk_hashes
 
+def _hash_block(block, length, chunk_size):
+    """
+    Returns the hex SHA-256 of every chunk in the first length bytes of block.
+    hashlib releases the GIL, so several blocks can be hashed in parallel.
+    """
+    view = memoryview(block)[:length]
+    return [hashlib.sha256(view[i:i + chunk_size]).hexdigest() for i in range(0, length, chunk_size)]
+
+def hash_file(filepath, chunk_size=None, workers=None, read_size=HASH_READ_SIZE):
+    """
+    Returns the list of chunk hashes for a file using constant memory.
+    The file is read in large sequential blocks that are hashed on a thread pool;
+    at most 2 * workers blocks are held in memory at once.
+    The chunk size defaults to choose_chunk_size for the file.
+    """
+    chunk_size = chunk_size or choose_chunk_size(os.path.getsize(filepath))
+    workers = workers or os.cpu_count() or 1
+    chunk_hashes = []
+    in_flight = deque()
+    with open(filepath, "rb", buffering=0) as f:
+        # Blocks hold whole chunks so no chunk straddles two blocks, and small files get small blocks
+        file_size = os.fstat(f.fileno()).st_size
+        read_size = min(read_size, file_size + chunk_size - 1)
+        read_size = max(chunk_size, read_size // chunk_size * chunk_size)
+        if file_size <= read_size:
+            # One block: hash it here rather than paying for a thread pool per small file
+            block = bytearray(read_size)
+            return _hash_block(block, _read_full(f, block), chunk_size)
+        with ThreadPoolExecutor(max_workers=workers) as pool:
+            while True:
+                block = bytearray(read_size)
+                length = _read_full(f, block)
+                if not length:
+                    break
+                in_flight.append(pool.submit(_hash_block, block, length, chunk_size))
+                if len(in_flight) >= 2 * workers:
+                    chunk_hashes.extend(in_flight.popleft().result())
+                if length < read_size:
+                    break
+            for future in in_flight:
+                chunk_hashes.extend(future.result())
+    return chunk_hashes
+
+def _read_full(f, buffer):
+    """
+    Fills buffer from an unbuffered file, returning fewer bytes only at EOF.
+    """
+    view = memoryview(buffer)
+    length = 0
+    while length < len(buffer):
+        n = f.readinto(view[length:])
+        if not n:
+            break
+        length += n
+    return length
+
+def hash_file_timed(filepath, chunk_size=None, workers=None):
+    """
+    Like hash_file, but also returns the hashing throughput in bytes per second.
+    """
+    start = time.perf_counter()
+    chunk_hashes = hash_file(filepath, chunk_size, workers)
+    elapsed = time.perf_counter() - start
+    size = os.path.getsize(filepath)
+    return chunk_hashes, (size / elapsed if elapsed > 0 else float("inf"))
+
 def verify_chunk(chunk_data, expected_hash):
     """
     Verifies that the SHA-256 hash of chunk_data matches expected_hash.
@@ -65,6 +331,78 @@ def verify_chunk(chunk_data, expected_hash):
     computed_hash = hashlib.sha256(chunk_data).hexdigest()
     return computed_hash == expected_hash
 
+def _merkle_parent(left, right):
+    # Domain-separated from leaves, which are plain chunk SHA-256 digests
+    return hashlib.sha256(b"\x01" + left + right).digest()
+
+def merkle_levels(chunk_hashes):
+    """
+    Builds a Merkle tree over hex chunk hashes. Returns the list of levels as raw
+    digests, leaves first and the root last. An unpaired node is promoted unchanged.
+    """
+    level = [bytes.fromhex(h) for h in chunk_hashes] or [hashlib.sha256(b"").digest()]
+    levels = [level]
+    while len(level) > 1:
+        level = [_merkle_parent(level[i], level[i + 1]) if i + 1 < len(level) else level[i]
+                 for i in range(0, len(level), 2)]
+        levels.append(level)
+    return levels
+
+def merkle_root(chunk_hashes):
+    """
+    Returns the hex Merkle root of a list of hex chunk hashes.
+    """
+    return merkle_levels(chunk_hashes)[-1][0].hex()
+
+def collection_root(files):
+    """
+    Returns the hex Merkle root of a collection manifest. Each leaf commits to one
+    file's path, size, chunk size and chunk hashes, in manifest order.
+    """
+    leaves = [hashlib.sha256(json.dumps([entry["path"], entry["file_size"], entry["chunk_size"],
+                                         merkle_root(entry["chunk_hashes"])]).encode()).hexdigest()
+              for entry in files]
+    return merkle_root(leaves)
+
+def merkle_range_proof(levels, start, end):
+    """
+    Returns the hex sibling hashes needed to rebuild the root from leaves [start, end).
+    """
+    proof = []
+    for level in levels[:-1]:
+        if start % 2:
+            proof.append(level[start - 1].hex())
+        if end % 2 and end < len(level):
+            proof.append(level[end].hex())
+        start, end = start // 2, (end + 1) // 2
+    return proof
+
+def verify_merkle_range(root, num_chunks, start, chunk_hashes, proof):
+    """
+    Checks that chunk_hashes are the leaves [start, start + len(chunk_hashes)) of the
+    Merkle tree with the given hex root and num_chunks leaves.
+    """
+    try:
+        nodes = [bytes.fromhex(h) for h in chunk_hashes]
+        siblings = iter(bytes.fromhex(h) for h in proof)
+        end = start + len(nodes)
+        width = num_chunks
+        if not nodes or start < 0 or end > width:
+            return False
+        while width > 1:
+            if start % 2:
+                nodes.insert(0, next(siblings))
+                start -= 1
+            if end % 2 and end < width:
+                nodes.append(next(siblings))
+                end += 1
+            nodes = [_merkle_parent(nodes[i], nodes[i + 1]) if i + 1 < len(nodes) else nodes[i]
+                     for i in range(0, len(nodes), 2)]
+            start, end, width = start // 2, (end + 1) // 2, (width + 1) // 2
+        return next(siblings, None) is None and nodes[0].hex() == root
+    except (ValueError, StopIteration):
+        return False
+
 def encode_chunk(chunk_data):
     """
     Encode binary chunk data to a Base64 string (for JSON serialization).
@@ -77,9 +415,103 @@ def decode_chunk(encoded_data):
     """
     return base64.b64decode(encoded_data.encode())
 
+class ChunkBitmap:
+    """
+    One bit per chunk recording which chunks are present and verified.
+    """
+    def __init__(self, num_chunks, data=None):
+        self.num_chunks = num_chunks
+        self.bits = bytearray(data) if data is not None else bytearray((num_chunks + 7) // 8)
+
+    def set(self, index):
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def __contains__(self, index):
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def count(self):
+        return sum(bin(b).count("1") for b in self.bits)
+
+    def missing(self):
+        """
+        Returns the indices of all chunks that are not set yet.
+        """
+        return [i for i in range(self.num_chunks) if i not in self]
+
+    def encode(self):
+        return base64.b64encode(bytes(self.bits)).decode()
+
+    @classmethod
+    def decode(cls, num_chunks, encoded):
+        return cls(num_chunks, base64.b64decode(encoded.encode()))
+
 def ensure_files_dir():
     """
     Ensure that the 'files' directory exists.
     """
     if not os.path.exists("files"):
         os.makedirs("files")
+
+def preallocate(fd, size):
+    """
+    Reserve size bytes for the file behind fd so chunks can be written at any offset.
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+            return
+        except OSError:
+            # Not supported by every filesystem; a sparse file works too
+            pass
+    os.ftruncate(fd, size)
+
+def read_at(fd, offset, length):
+    """
+    Read up to length bytes at offset from the file behind fd. Safe to call from several threads.
+    """
+    if hasattr(os, "pread"):
+        return os.pread(fd, length, offset)
+    with _SEEK_LOCK:
+        os.lseek(fd, offset, os.SEEK_SET)
+        return os.read(fd, length)
+
+def send_file_range(sock, fd, offset, length):
+    """
+    Send length bytes at offset of the file behind fd. Uses os.sendfile so the data goes
+    from the page cache to the socket without passing through user space.
+    """
+    if hasattr(os, "sendfile"):
+        while length > 0:
+            try:
+                sent = os.sendfile(sock.fileno(), fd, offset, length)
+            except BlockingIOError:
+                # Sockets with a timeout are non-blocking underneath; wait until writable
+                if not select.select([], [sock], [], sock.gettimeout())[1]:
+                    raise TimeoutError("Timed out sending file data")
+                continue
+            if sent == 0:
+                raise EOFError("File shrank while sending")
+            offset += sent
+            length -= sent
+        return
+    data = read_at(fd, offset, length)
+    if len(data) < length:
+        raise EOFError("File shrank while sending")
+    sock.sendall(data)
+
+def write_at(fd, offset, data):
+    """
+    Write data at offset in the file behind fd. Safe to call from several threads.
+    """
+    if hasattr(os, "pwrite"):
+        view = memoryview(data)
+        while view:
+            written = os.pwrite(fd, view, offset)
+            view = view[written:]
+            offset += written
+        return
+    with _SEEK_LOCK:
+        os.lseek(fd, offset, os.SEEK_SET)
+        view = memoryview(data)
+        while view:
+            view = view[os.write(fd, view):]